@@ -1,16 +1,47 @@
+import functools
+import hashlib
 import io
+import logging
 import os
 import sqlite3
-from datetime import date, datetime
+import sys
+import threading
+import time
+from datetime import datetime
 
-import pytz
+# Medido antes dos imports pesados; só a primeira execução do processo
+# (partida a frio) importa o backend, o pandas e companhia
+_inicio_execucao = time.perf_counter()
+_partida_a_frio = "backend" not in sys.modules
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import requests
 import streamlit as st
-from requests.auth import HTTPBasicAuth
+
+from backend import (
+    COLUNAS_CATEGORIA,
+    COLUNAS_LEITURA,
+    COLUNAS_RESUMO,
+    FUSO_SP,
+    SNAPSHOT_DIR,
+    _conectar,
+    configurar_api,
+    estado_sync,
+    iniciar_sync_em_segundo_plano,
+    init_db,
+    precisa_sincronizar,
+    ultima_sincronizacao,
+    versao_dados,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    from pyarrow.fs import LocalFileSystem
+except ImportError:  # sem pyarrow a leitura vai direto ao SQLite
+    pa = None
+
+log = logging.getLogger("fpm")
 
 # --- 1. CONFIGURAÇÃO VISUAL ---
 st.set_page_config(
@@ -137,388 +168,851 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+
 # --- 2. CONFIGURAÇÕES ---
-DB_FILE = "dados_fazenda.db"
-BASE_URL = st.secrets["api"]["base_url"]
-CLIENTE = st.secrets["api"]["cliente"]
-TOKEN = st.secrets["api"]["token"]
-AUTH_USER = st.secrets["api"]["auth_user"]
-AUTH_PASS = st.secrets["api"]["auth_pass"]
-
-# Fuso horário padrão — Streamlit Cloud roda em UTC
-FUSO_SP = pytz.timezone("America/Sao_Paulo")
-
-FILIAIS_ALVO = ["2", "5", "1"]
-ID_UNIDADE = "1"
-TIPO_TICKET = "Entrada Produção"
-
-PALAVRAS_PROIBIDAS = [
-    "FILTRO",
-    "OLEO",
-    "ÓLEO",
-    "PECA",
-    "PEÇA",
-    "PARAFUSO",
-    "ARRUELA",
-    "LUBRIFICANTE",
-    "ADUB",
-    "FERTILIZANTE",
-    "SEMENTE",
-    "DIESEL",
-    "ZETHA",
-    "HERBICIDA",
-    "FUNGICIDA",
-]
+# Tempo máximo de uma execução do script até a página pronta; acima disso
+# fica registrado no log como aviso
+ORCAMENTO_PARTIDA_SEG = 2.0  # primeira execução do processo (imports e banco)
+ORCAMENTO_EXECUCAO_SEG = 1.0  # demais execuções
+
+
+def _registrar_execucao():
+    """Registra quanto a execução levou e avisa se passou do orçamento."""
+    decorrido = time.perf_counter() - _inicio_execucao
+    if _partida_a_frio:
+        orcamento, tipo = ORCAMENTO_PARTIDA_SEG, "Partida a frio"
+    else:
+        orcamento, tipo = ORCAMENTO_EXECUCAO_SEG, "Execução"
+    if decorrido > orcamento:
+        log.warning("%s em %.2fs (orçamento: %.1fs)", tipo, decorrido, orcamento)
+    elif _partida_a_frio:
+        log.info("%s em %.2fs", tipo, decorrido)
+    else:
+        log.debug("%s em %.2fs", tipo, decorrido)
+
+
+@st.cache_resource
+def _preparar_banco():
+    """Migrações e snapshot inicial: uma vez por processo, não a cada execução."""
+    init_db()
+
+
+# Banco, API e sincronização ficam em backend.py (roda também fora do Streamlit)
+configurar_api(st.secrets["api"])
+_preparar_banco()
 
 
 # --- 3. BACKEND ---
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    try:
-        c.execute("SELECT obs FROM analise_produtividade LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("DROP TABLE IF EXISTS analise_produtividade")
-        conn.commit()
-
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS analise_produtividade (
-            id_ticket TEXT PRIMARY KEY, data TEXT, numero_romaneio TEXT,
-            local_safra TEXT, safra_agricola TEXT, produto_full TEXT,
-            cultura TEXT, variedade TEXT, divisor REAL, peso_bruto REAL,
-            desconto REAL, peso_liquido REAL, sacas REAL, hectares REAL,
-            id_local_estoque TEXT, obs TEXT
-        )
+# Níveis do filtro em cascata, na ordem da sidebar (todos são colunas indexadas)
+NIVEIS_FILTRO = ("cultura", "safra_agricola", "talhao_limpo", "variedade")
+
+
+def _where_filtros(datas=None, **selecoes):
+    """Traduz as seleções da sidebar em cláusula WHERE parametrizada.
+
+    `selecoes` usa os nomes de NIVEIS_FILTRO; seleções vazias não filtram.
     """
-    )
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sync_log (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            ultima_sync TEXT
-        )
+    clausulas = []
+    params = []
+    if datas:
+        clausulas.append("data >= ? AND data <= ?")
+        params += [datas[0].isoformat(), datas[1].isoformat()]
+    for coluna, valores in selecoes.items():
+        if coluna not in NIVEIS_FILTRO:
+            raise ValueError(f"Filtro desconhecido: {coluna}")
+        if valores:
+            clausulas.append(f"{coluna} IN ({', '.join('?' * len(valores))})")
+            params += list(valores)
+    return " AND ".join(clausulas) or "1", params
+
+
+class CacheDados:
+    """Cache do processo, compartilhado por todas as sessões.
+
+    Guarda (chave → versão, valor), onde a versão é a dos dados no banco
+    (sync_log.versao). Uma sync nova não apaga nada: quem pede uma chave
+    calcula o valor da versão nova uma única vez (single-flight), e as
+    demais sessões continuam recebendo o valor anterior até ele ficar
+    pronto. Só as duas versões mais recentes ficam em memória.
+
+    Os valores são compartilhados: trate os DataFrames como somente leitura.
     """
-    )
-    conn.commit()
-    conn.close()
 
+    def __init__(self, max_entradas=256):
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._entradas = {}  # chave -> (versao, valor), em ordem de uso
+        self._calculando = {}  # (chave, versao) -> threading.Event
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, versao, chave, calcular):
+        while True:
+            with self._lock:
+                atual = self._entradas.get(chave)
+                if atual is not None and atual[0] >= versao:
+                    self._entradas[chave] = self._entradas.pop(chave)
+                    self.acertos += 1
+                    return atual[1]
+                evento = self._calculando.get((chave, versao))
+                if evento is None:
+                    evento = self._calculando[(chave, versao)] = threading.Event()
+                    self.falhas += 1
+                    break
+                if atual is not None:
+                    self.acertos += 1
+            if atual is not None:
+                return atual[1]  # versão anterior enquanto a nova é calculada
+            evento.wait()
 
-def get_json(endpoint, d_ini=None, d_fim=None):
-    if d_ini and d_fim:
-        url = f"{BASE_URL}/{endpoint}/{d_ini}/{d_fim}/{CLIENTE}/{TOKEN}"
-    else:
-        url = f"{BASE_URL}/{endpoint}/{CLIENTE}/{TOKEN}"
-    try:
-        r = requests.get(url, auth=HTTPBasicAuth(AUTH_USER, AUTH_PASS))
-        return r.json() if r.status_code == 200 else []
-    except:
-        return []
+        try:
+            valor = calcular()
+            with self._lock:
+                self._entradas.pop(chave, None)
+                self._entradas[chave] = (versao, valor)
+                self._despejar(versao)
+            return valor
+        finally:
+            with self._lock:
+                del self._calculando[(chave, versao)]
+            evento.set()
+
+    def estatisticas(self):
+        """Acertos, falhas (valores calculados) e entradas em memória."""
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                "acertos": self.acertos,
+                "falhas": self.falhas,
+                "taxa_acerto": self.acertos / total if total else 0.0,
+                "entradas": len(self._entradas),
+            }
 
+    def _despejar(self, versao):
+        velhas = [k for k, (v, _) in self._entradas.items() if v < versao - 1]
+        for k in velhas:
+            del self._entradas[k]
+        while len(self._entradas) > self.max_entradas:
+            del self._entradas[next(iter(self._entradas))]
 
-def sincronizar_dados(modo="parcial"):
-    status = st.empty()
-    bar = st.progress(0)
-    hoje = datetime.now(FUSO_SP)
 
-    if modo == "parcial":
-        dt_inicio = date(hoje.year, hoje.month, 1)
-        dt_fim = hoje.date()
-    else:
-        dt_inicio = date(2020, 1, 1)
-        dt_fim = hoje.date()
-
-    str_ini = dt_inicio.strftime("%d%m%Y")
-    str_fim = dt_fim.strftime("%d%m%Y")
-
-    status.info("Baixando Cadastros...")
-    areas = get_json("areas")
-    subareas = get_json("subareas")
-    anos = get_json("anos")
-    produtos = get_json("produtos")
-    nomes_prod = get_json("produtosnomes")
-    variedades = get_json("produtosvariedades")
-    bar.progress(15)
-
-    map_areas = {a["idArea"]: a["area"] for a in areas}
-    map_sub = {
-        s["idSubArea"]: {"nome": s["subArea"], "pai": s["idArea"]} for s in subareas
-    }
-    map_local_final = {}
-    map_safra_ano = {}
-
-    for a in anos:
-        d_sub = map_sub.get(a.get("idSubArea"))
-        ano_label = a.get("ano")
-        map_safra_ano[a.get("idAno")] = ano_label
-        if d_sub:
-            fazenda = map_areas.get(d_sub["pai"], "Desc.")
-            map_local_final[a.get("idAno")] = (
-                f"{fazenda} - {d_sub['nome']} ({ano_label})"
-            )
-        else:
-            map_local_final[a.get("idAno")] = f"ID {a.get('idAno')}"
+@st.cache_resource
+def _cache_dados():
+    return CacheDados()
 
-    map_nomes = {
-        p["idNomeProduto"]: p["nomeProduto"].upper()
-        for p in nomes_prod
-        if p.get("nomeProduto")
-    }
-    map_var = {
-        v["idVariedade"]: v["nomeVariedade"].upper()
-        for v in variedades
-        if v.get("nomeVariedade")
-    }
-    map_prod_final = {}
-
-    for p in produtos:
-        # Filtro primário: apenas produtos do grupo 12 (Produtos Produzidos)
-        if str(p.get("idGrupo")) != "12":
-            continue
-
-        n_base = map_nomes.get(p.get("idNomeProduto"), "DESC")
-        n_var = map_var.get(p.get("idVariedade"), "")
-
-        # Filtro secundário: palavras proibidas como dupla segurança
-        eh_lixo = any(proibida in n_base for proibida in PALAVRAS_PROIBIDAS)
-
-        if not eh_lixo:
-            p_id = str(p.get("idProduto"))
-            if n_var and n_var != "NH-NENHUM":
-                nome_full = f"{n_base} ({n_var}) #{p_id}" 
-                var_clean = n_var
-            else:
-                nome_full = f"{n_base} #{p_id}"
-                var_clean = "COMUM"
-            
-            div = 50.0 if "BATATA" in n_base else 60.0
-            map_prod_final[p_id] = {
-                "nome_full": nome_full,
-                "cultura": n_base,
-                "variedade": var_clean,
-                "divisor": div,
-            }
 
-    status.info("Baixando Movimentações...")
-    tickets = get_json("ticketscompras", str_ini, str_fim)
-    bar.progress(40)
+@st.cache_resource
+def _cache_selecoes():
+    # Linhas cruas de cada seleção da sidebar: grandes e variadas, poucas em memória
+    return CacheDados(max_entradas=8)
 
-    valid_tickets = {}
-    for t in tickets:
-        unid_fat = str(t.get("idUnidadeFaturamento") or "")
-        eh_unidade_valida = (unid_fat == ID_UNIDADE) or (unid_fat in ["", "None", "0"])
 
-        if (
-            str(t.get("idFilial")) in FILIAIS_ALVO
-            and eh_unidade_valida
-            and TIPO_TICKET in str(t.get("tipoTicket", ""))
-        ):
+@st.cache_resource
+def _cache_exportacoes():
+    return CacheDados(max_entradas=4)  # arquivos inteiros: poucos em memória
 
-            obs_txt = t.get("observacao") or t.get("obs") or ""
 
-            valid_tickets[t.get("idTicketCompra")] = {
-                "numero": t.get("numeroTicket"),
-                "data": t.get("dataTicket"),
-                "obs": obs_txt,
-            }
+def em_cache_de_dados(func=None, *, cache=_cache_dados):
+    """Guarda o resultado de `func` no CacheDados, pela versão atual dos dados."""
+    if func is None:
+        return functools.partial(em_cache_de_dados, cache=cache)
 
-    itens = get_json("ticketscomprasitens", str_ini, str_fim)
-    destinacoes = get_json("ticketscomprasdestinacoes", str_ini, str_fim)
-    bar.progress(70)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        chave = (func.__name__, args, tuple(sorted(kwargs.items())))
+        return cache().obter(versao_dados(), chave, lambda: func(*args, **kwargs))
 
-    item_map = {}
-    for i in itens:
-        if i.get("idTicketCompra") in valid_tickets:
-            item_map[i.get("idTicketCompraItem")] = {
-                "tid": i.get("idTicketCompra"),
-                "pid": str(i.get("idProduto")),
-            }
+    return wrapper
 
-    rows = []
 
-    for d in destinacoes:
-        iid = d.get("idTicketCompraItem")
-        if iid in item_map:
-            info_item = item_map[iid]
-            pid = info_item["pid"]
+class FiltroCascata:
+    """Filtro em cascata da sidebar, em memória, sobre o resumo diário.
 
-            if pid not in map_prod_final:
-                continue
+    As linhas ficam em ordem de data, guardada como dia ordinal (int64): o
+    período é uma fatia achada por busca binária. Cada nível de NIVEIS_FILTRO
+    fica como códigos de categoria, e a seleção de um nível vira uma tabela
+    booleana indexada pelo código. Nenhum passo copia o DataFrame; só o
+    resultado de `selecionar` é extraído.
+    """
 
-            p_data = map_prod_final[pid]
-            info_ticket = valid_tickets[info_item["tid"]]
-
-            id_ano_origem = d.get("idAno") or d.get("safra")
-            nome_local = map_local_final.get(id_ano_origem, "N/D")
-            safra_lbl = map_safra_ano.get(id_ano_origem, "N/D")
-
-            try:
-                qtd = float(d.get("quantidade") or 0)
-                desc = float(d.get("quantidadeDesconto") or 0)
-                hec = float(str(d.get("hectare") or 0).replace(",", "."))
-                liq = qtd - desc
-                sacas = liq / p_data["divisor"]
-
-                if sacas <= 0:
-                    continue
-
-                dt_sql = info_ticket["data"].split(" ")[0]
-
-                rows.append(
-                    {
-                        "id_ticket": d.get("idTicketCompraDestinacao"),
-                        "data": dt_sql,
-                        "numero_romaneio": info_ticket["numero"],
-                        "local_safra": nome_local,
-                        "safra_agricola": safra_lbl,
-                        "produto_full": p_data["nome_full"],
-                        "cultura": p_data["cultura"],
-                        "variedade": p_data["variedade"],
-                        "divisor": p_data["divisor"],
-                        "peso_bruto": qtd,
-                        "desconto": desc,
-                        "peso_liquido": liq,
-                        "sacas": sacas,
-                        "hectares": hec,
-                        "id_local_estoque": str(d.get("idLocalEstoque")),
-                        "obs": info_ticket["obs"],
-                    }
-                )
-            except:
-                continue
+    def __init__(self, df):
+        self.df = df.sort_values("data", kind="stable", ignore_index=True)
+        self._dias = (
+            self.df["data"].to_numpy().astype("datetime64[D]").astype(np.int64)
+        )
+        self._categorias = {n: self.df[n].cat.categories for n in NIVEIS_FILTRO}
+        self._codigos = {n: self.df[n].cat.codes.to_numpy() for n in NIVEIS_FILTRO}
+
+    def limites(self):
+        """Primeira e última data, ou None se não há linhas."""
+        if not len(self._dias):
+            return None
+        d_min, d_max = self._dias[[0, -1]].astype("datetime64[D]").tolist()
+        return d_min, d_max
+
+    def _fatia(self, datas):
+        if not datas:
+            return slice(0, len(self._dias))
+        ini, fim = (np.datetime64(d, "D").astype(np.int64) for d in datas)
+        return slice(
+            self._dias.searchsorted(ini, "left"), self._dias.searchsorted(fim, "right")
+        )
 
-    conn = sqlite3.connect(DB_FILE)
-    if modo == "total":
-        if rows:
-            df_new = pd.DataFrame(rows)
-            df_new["data"] = pd.to_datetime(df_new["data"])
-            df_new.to_sql(
-                "analise_produtividade", conn, if_exists="replace", index=False
-            )
-    elif modo == "parcial":
-        cursor = conn.cursor()
-        sql_del = "DELETE FROM analise_produtividade WHERE data >= ? AND data <= ?"
-        cursor.execute(
-            sql_del, (dt_inicio.strftime("%Y-%m-%d"), dt_fim.strftime("%Y-%m-%d"))
+    def _mascara(self, fatia, selecoes):
+        """Linhas da fatia que passam nas seleções, ou None se nenhuma filtra."""
+        mascara = None
+        for nivel, valores in selecoes.items():
+            if nivel not in NIVEIS_FILTRO:
+                raise ValueError(f"Filtro desconhecido: {nivel}")
+            if not valores:
+                continue
+            categorias = self._categorias[nivel]
+            tabela = np.zeros(len(categorias) + 1, dtype=bool)  # +1: código -1
+            tabela[categorias.get_indexer(list(valores))] = True
+            tabela[-1] = False
+            linhas = tabela[self._codigos[nivel][fatia]]
+            mascara = linhas if mascara is None else mascara & linhas
+        return mascara
+
+    def opcoes(self, coluna, datas, **selecoes):
+        """Valores presentes em `coluna`, em ordem, dados os outros níveis."""
+        fatia = self._fatia(datas)
+        codigos = self._codigos[coluna][fatia]
+        mascara = self._mascara(fatia, selecoes)
+        if mascara is not None:
+            codigos = codigos[mascara]
+        categorias = self._categorias[coluna]
+        presentes = np.bincount(codigos[codigos >= 0], minlength=len(categorias))
+        return categorias[presentes > 0].tolist()
+
+    def selecionar(self, datas, **selecoes):
+        """As linhas da seleção, num DataFrame novo."""
+        fatia = self._fatia(datas)
+        linhas = np.arange(fatia.start, fatia.stop)
+        mascara = self._mascara(fatia, selecoes)
+        if mascara is not None:
+            linhas = linhas[mascara]
+        return self.df.take(linhas)
+
+
+@em_cache_de_dados
+def filtro_cascata():
+    """FiltroCascata sobre o resumo diário inteiro, um por versão dos dados."""
+    conn = _conectar()
+    try:
+        df = pd.read_sql(
+            f"SELECT {', '.join(COLUNAS_RESUMO)} FROM resumo_diario ORDER BY data",
+            conn,
         )
-        conn.commit()
-        if rows:
-            df_new = pd.DataFrame(rows)
-            df_new["data"] = pd.to_datetime(df_new["data"])
-            df_new.to_sql(
-                "analise_produtividade", conn, if_exists="append", index=False
-            )
-    conn.close()
+    finally:
+        conn.close()
+    df["data"] = pd.to_datetime(df["data"], format="%Y-%m-%d")
+    return FiltroCascata(df.astype({col: "category" for col in COLUNAS_CATEGORIA}))
+
+
+def limites_datas():
+    """Primeira e última data com dados, ou None se o banco está vazio."""
+    return filtro_cascata().limites()
+
+
+def opcoes_filtro(coluna, datas, **selecoes):
+    """Valores distintos de um nível da cascata, dados os níveis anteriores."""
+    return filtro_cascata().opcoes(coluna, datas, **selecoes)
 
-    # Registra timestamp da sincronização no banco
-    conn_log = sqlite3.connect(DB_FILE)
-    conn_log.execute(
-        "INSERT OR REPLACE INTO sync_log (id, ultima_sync) VALUES (1, ?)",
-        (datetime.now(FUSO_SP).isoformat(),),
-    )
-    conn_log.commit()
-    conn_log.close()
 
-    bar.progress(100)
-    status.success(f"Atualizado! {len(rows)} registros.")
-    st.cache_data.clear()
+def _ler_snapshot(datas, **selecoes):
+    """Lê a seleção do snapshot Parquet (memory-map, só as colunas usadas)."""
+    dataset = ds.dataset(
+        SNAPSHOT_DIR,
+        format="parquet",
+        # Tipo explícito: sem ele, safras só com dígitos ("2024") viriam como int
+        partitioning=ds.partitioning(
+            pa.schema([("safra_agricola", pa.string())]), flavor="hive"
+        ),
+        filesystem=LocalFileSystem(use_mmap=True),
+    )
+    filtro = (ds.field("data") >= datas[0]) & (ds.field("data") <= datas[1])
+    for coluna, valores in selecoes.items():
+        if valores:
+            # A safra é a partição: pastas de outras safras nem são abertas
+            filtro &= ds.field(coluna).isin(list(valores))
+    tabela = dataset.to_table(columns=COLUNAS_LEITURA, filter=filtro)
+    return tabela.to_pandas(date_as_object=False)
 
 
-init_db()
+@em_cache_de_dados(cache=_cache_selecoes)
+def ler_dados(datas, **selecoes):
+    """Carrega só as linhas da seleção atual da sidebar, já tipadas.
 
+    Lê do snapshot Parquet gerado pela sync; sem ele, do SQLite. A limpeza
+    (talhao_limpo, produtos proibidos, "N/D") é feita na sync.
+    """
+    where, params = _where_filtros(datas, **selecoes)
+    if pa is not None and os.path.isdir(SNAPSHOT_DIR):
+        try:
+            df = _ler_snapshot(datas, **selecoes)
+            df["data"] = df["data"].astype("datetime64[ns]")
+            return df.astype({col: "category" for col in COLUNAS_CATEGORIA})
+        except (OSError, pa.ArrowException):
+            log.exception("Snapshot ilegível; lendo do SQLite")
 
-def precisa_sincronizar() -> bool:
-    """Retorna True se a última sync é anterior às 06:00 de hoje (SP)."""
+    conn = _conectar()
     try:
-        conn = sqlite3.connect(DB_FILE)
-        row = conn.execute(
-            "SELECT ultima_sync FROM sync_log WHERE id = 1"
-        ).fetchone()
-        conn.close()
-        if not row:
-            return True  # Nunca sincronizou
-        ultima = datetime.fromisoformat(row[0])
-        if ultima.tzinfo is None:
-            ultima = FUSO_SP.localize(ultima)
-        limite = datetime.now(FUSO_SP).replace(
-            hour=6, minute=0, second=0, microsecond=0
+        df = pd.read_sql(
+            f"SELECT {', '.join(COLUNAS_LEITURA)} "
+            f"FROM analise_produtividade WHERE {where}",
+            conn,
+            params=params,
         )
-        return ultima < limite
-    except Exception:
-        return True
+        df["data"] = pd.to_datetime(df["data"], format="%Y-%m-%d")
+        return df.astype({col: "category" for col in COLUNAS_CATEGORIA})
+    finally:
+        conn.close()
 
 
-@st.cache_data(ttl=300)
-def ler_dados():
-    conn = sqlite3.connect(DB_FILE)
-    try:
-        df = pd.read_sql("SELECT * FROM analise_produtividade", conn)
-        if df.empty or "safra_agricola" not in df.columns:
-            return pd.DataFrame()
-
-        df["data"] = pd.to_datetime(df["data"])
-        df["safra_agricola"] = df["safra_agricola"].astype(str).replace("nan", "N/D")
-        df["variedade"] = df["variedade"].astype(str)
-        df["talhao_limpo"] = df["local_safra"].str.replace(
-            r"\s\(\d{2,4}.*\)", "", regex=True
+@em_cache_de_dados(cache=_cache_selecoes)
+def ler_resumo(datas, **selecoes):
+    """Resumo diário (dia × talhão × produto) da seleção, para as agregações.
+
+    Tem as mesmas colunas de filtro de ler_dados, mas uma linha por dia e
+    produto em vez de uma por romaneio: `hectares` é o maior do dia.
+    """
+    return filtro_cascata().selecionar(datas, **selecoes)
+
+
+# Agregações do dashboard: funções puras da seleção, guardadas no CacheDados
+# pela versão dos dados. `destaque` são as variedades clicadas no ranking.
+CHAVES_AREA = ["safra_agricola", "local_safra", "cultura", "produto_full"]
+LINHAS_TOP = 50  # romaneios por página nos recentes e na auditoria
+COLUNAS_RECENTES = [
+    "data",
+    "numero_romaneio",
+    "talhao_limpo",
+    "cultura",
+    "variedade",
+    "peso_liquido",
+    "sacas",
+]
+COLUNAS_AUDITORIA = [
+    "data",
+    "numero_romaneio",
+    "produto_full",
+    "sacas",
+    "hectares",
+    "obs",
+]
+
+
+def _resumo_destaque(datas, destaque, **selecoes):
+    df = ler_resumo(datas, **selecoes)
+    if destaque:
+        df = df[df["variedade"].isin(destaque)]
+    return df
+
+
+@em_cache_de_dados
+def indicadores(datas, **selecoes):
+    """Produtividade, sacas, área e volume líquido da seleção."""
+    df = ler_resumo(datas, **selecoes)
+    tot_ha = df.groupby(CHAVES_AREA, observed=True)["hectares"].max().sum()
+    tot_sacas = df["sacas"].sum()
+    return {
+        "produtividade": tot_sacas / tot_ha if tot_ha > 0 else 0,
+        "sacas": tot_sacas,
+        "hectares": tot_ha,
+        "toneladas": df["peso_liquido"].sum() / 1000,
+    }
+
+
+@em_cache_de_dados
+def ranking_variedades(datas, **selecoes):
+    """Sacas, hectares e produtividade por variedade, da maior para a menor."""
+    df = ler_resumo(datas, **selecoes)
+    df_var_area = (
+        df.groupby(
+            ["cultura", "variedade", "produto_full", "local_safra"], observed=True
+        )["hectares"]
+        .max()
+        .reset_index()
+    )
+    df_var_area_sum = (
+        df_var_area.groupby(["cultura", "variedade"], observed=True)["hectares"]
+        .sum()
+        .reset_index()
+    )
+
+    talhoes_validos = df_var_area["local_safra"].unique()
+    df_sacas_validas = df[df["local_safra"].isin(talhoes_validos)]
+    df_var_sacas_sum = (
+        df_sacas_validas.groupby(["cultura", "variedade"], observed=True)["sacas"]
+        .sum()
+        .reset_index()
+    )
+
+    df_rank = pd.merge(df_var_sacas_sum, df_var_area_sum, on=["cultura", "variedade"])
+    df_rank["yield"] = df_rank["sacas"] / df_rank["hectares"]
+    return df_rank.sort_values("yield", ascending=False)
+
+
+@em_cache_de_dados
+def perdas(datas, destaque, **selecoes):
+    """(peso líquido, desconto) somados, em kg."""
+    df = _resumo_destaque(datas, destaque, **selecoes)
+    return df["peso_liquido"].sum(), df["desconto"].sum()
+
+
+# Evolução: o tamanho da barra cresce com o período, para o gráfico ter no
+# máximo BARRAS_EVOLUCAO barras por talhão, e só os TALHOES_EVOLUCAO maiores
+# talhões têm cor própria (o resto vai para "Outros")
+BARRAS_EVOLUCAO = 120
+TALHOES_EVOLUCAO = 8
+# (frequência do pandas, título, dias por barra, formato da data)
+ESCALAS_EVOLUCAO = [
+    ("D", "Diária", 1, "%d/%m/%Y"),
+    ("W", "Semanal", 7, "%d/%m/%Y"),
+    ("M", "Mensal", 30.44, "%m/%Y"),
+    ("Q", "Trimestral", 91.31, "%m/%Y"),
+    ("Y", "Anual", 365.25, "%Y"),
+]
+
+
+def escala_evolucao(datas):
+    """A menor escala de ESCALAS_EVOLUCAO que cabe em BARRAS_EVOLUCAO barras."""
+    dias = (datas[1] - datas[0]).days + 1
+    for escala in ESCALAS_EVOLUCAO:
+        if dias / escala[2] <= BARRAS_EVOLUCAO:
+            return escala
+    return ESCALAS_EVOLUCAO[-1]
+
+
+@em_cache_de_dados
+def evolucao_talhoes(datas, destaque, **selecoes):
+    """Toneladas por período e talhão, em ordem de data.
+
+    `periodo` é o início de cada barra (datetime) e `rotulo`, o texto dele.
+    """
+    freq, _, _, formato = escala_evolucao(datas)
+    df = _resumo_destaque(datas, destaque, **selecoes)
+    toneladas = df["peso_liquido"] / 1000
+    talhao = df["talhao_limpo"]
+    total = toneladas.groupby(talhao, observed=True).sum()
+    if len(total) > TALHOES_EVOLUCAO + 1:
+        maiores = total.nlargest(TALHOES_EVOLUCAO).index
+        talhao = talhao.astype(object).where(talhao.isin(maiores), "Outros")
+    periodo = df["data"].dt.to_period(freq).dt.start_time
+
+    df_evo = (
+        toneladas.groupby([periodo.rename("periodo"), talhao], observed=True)
+        .sum()
+        .rename("toneladas")
+        .reset_index()
+    )
+    # Só os rótulos agregados viram texto
+    df_evo["rotulo"] = df_evo["periodo"].dt.strftime(formato)
+    if freq == "W":
+        df_evo["rotulo"] = "Semana de " + df_evo["rotulo"]
+    return df_evo
+
+
+@em_cache_de_dados
+def detalhamento(datas, destaque, **selecoes):
+    """Hectares, sacas e produtividade por safra/talhão/produto."""
+    df_tab_base = (
+        _resumo_destaque(datas, destaque, **selecoes)
+        .groupby(
+            ["safra_agricola", "local_safra", "cultura", "variedade", "produto_full"],
+            observed=True,
         )
+        .agg({"hectares": "max", "sacas": "sum"})
+        .reset_index()
+    )
 
-        filtro_lixo = "|".join(PALAVRAS_PROIBIDAS)
-        df = df[~df["produto_full"].str.contains(filtro_lixo, case=False, na=False)]
-        df = df[df["sacas"] > 0]
+    df_tab_base["produtividade"] = df_tab_base["sacas"] / df_tab_base["hectares"]
+    df_tab_base = df_tab_base[df_tab_base["produtividade"] <= 2000]
+    return df_tab_base.sort_values("produtividade", ascending=False)
 
-        return df
-    except:
-        return pd.DataFrame()
-    finally:
-        conn.close()
+
+def _primeiras_linhas(df, valores, colunas, n=LINHAS_TOP, pagina=1):
+    """A `pagina` de `n` linhas com maiores `valores`, com as `colunas` pedidas.
+
+    Seleção parcial (nlargest): só as pagina × n maiores são ordenadas, nunca
+    a seleção inteira, e só as linhas da página são copiadas.
+    """
+    linhas = valores.nlargest(pagina * n).index[(pagina - 1) * n :]
+    return df.loc[linhas, colunas]
+
+
+def _sacas_destaque(datas, destaque, **selecoes):
+    df = ler_dados(datas, **selecoes)
+    if destaque:
+        return df, df["sacas"][df["variedade"].isin(destaque)]
+    return df, df["sacas"]
+
+
+@em_cache_de_dados
+def qtd_cargas(datas, destaque, **selecoes):
+    """Quantos romaneios entram na auditoria (e nos recentes, sem destaque)."""
+    return len(_sacas_destaque(datas, destaque, **selecoes)[1])
+
+
+@em_cache_de_dados
+def maiores_cargas(datas, destaque, pagina=1, n=LINHAS_TOP, **selecoes):
+    """Os romaneios com mais sacas, `n` por página."""
+    df, sacas = _sacas_destaque(datas, destaque, **selecoes)
+    return _primeiras_linhas(df, sacas, COLUNAS_AUDITORIA, n, pagina)
+
+
+@em_cache_de_dados
+def romaneios_recentes(datas, pagina=1, n=LINHAS_TOP, **selecoes):
+    """Os romaneios mais recentes, `n` por página."""
+    df = ler_dados(datas, **selecoes)
+    return _primeiras_linhas(df, df["data"], COLUNAS_RECENTES, n, pagina)
+
+
+# Exportação: o arquivo só é gerado quando o botão é clicado
+COLUNAS_EXPORT = [
+    "data",
+    "numero_romaneio",
+    "local_safra",
+    "safra_agricola",
+    "cultura",
+    "variedade",
+    "peso_bruto",
+    "desconto",
+    "peso_liquido",
+    "sacas",
+    "hectares",
+    "obs",
+]
+LINHAS_CSV = 100_000  # acima disso o CSV também é oferecido (bem mais rápido)
+LINHAS_MAX_EXCEL = 1_048_575  # limite de uma planilha, sem o cabeçalho
+AMOSTRA_LARGURA = 1_000  # valores usados para estimar a largura das colunas
+
+
+def _colunas_export(df):
+    """As colunas exportadas, com a data já como texto (sem copiar o resto)."""
+    cols = [c for c in COLUNAS_EXPORT if c in df.columns]
+    colunas = {c: df[c] for c in cols}
+    if "data" in colunas:
+        colunas["data"] = colunas["data"].dt.strftime("%d/%m/%Y")
+    return colunas
+
+
+def _largura(nome, valores):
+    """Largura da coluna: o maior texto entre as categorias ou uma amostra."""
+    if isinstance(valores.dtype, pd.CategoricalDtype):
+        valores = valores.cat.categories.to_series()
+    elif len(valores) > AMOSTRA_LARGURA:
+        valores = valores.sample(AMOSTRA_LARGURA, random_state=0)
+    maior = valores.astype(str).str.len().max() if len(valores) else 0
+    return max(maior, len(nome)) + 2
+
+
+def _sem_nan(valores):
+    """NaN vira None (célula vazia, como no to_excel); o xlsxwriter recusa NaN."""
+    if valores.hasnans:
+        return valores.astype(object).where(valores.notna(), None)
+    return valores
 
 
 def converter_df_para_excel(df):
+    """Planilha .xlsx escrita linha a linha (constant_memory do xlsxwriter)."""
+    import xlsxwriter
+
     output = io.BytesIO()
-    colunas_export = [
-        "data",
-        "numero_romaneio",
-        "local_safra",
-        "safra_agricola",
-        "cultura",
-        "variedade",
-        "peso_bruto",
-        "desconto",
-        "peso_liquido",
-        "sacas",
-        "hectares",
-        "obs",
-    ]
-    cols_existentes = [c for c in colunas_export if c in df.columns]
-    df_export = df[cols_existentes].copy()
-    if "data" in df_export.columns:
-        df_export["data"] = df_export["data"].dt.strftime("%d/%m/%Y")
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df_export.to_excel(writer, index=False, sheet_name="Dados Detalhados")
-        worksheet = writer.sheets["Dados Detalhados"]
-        for i, col in enumerate(df_export.columns):
-            max_len = max(df_export[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.set_column(i, i, max_len)
+    colunas = _colunas_export(df)
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    worksheet = workbook.add_worksheet("Dados Detalhados")
+    negrito = workbook.add_format({"bold": True, "border": 1})
+    for i, (nome, valores) in enumerate(colunas.items()):
+        worksheet.set_column(i, i, _largura(nome, valores))
+    worksheet.write_row(0, 0, list(colunas), negrito)
+    # constant_memory exige as linhas em ordem; tolist() dá tipos nativos
+    linhas = zip(*(_sem_nan(valores).tolist() for valores in colunas.values()))
+    for n, linha in enumerate(linhas, start=1):
+        worksheet.write_row(n, 0, linha)
+    workbook.close()
     return output.getvalue()
 
 
+def converter_df_para_csv(df):
+    """CSV no padrão do Excel brasileiro (";" e vírgula decimal), em UTF-8."""
+    return pd.DataFrame(_colunas_export(df)).to_csv(
+        index=False, sep=";", decimal=","
+    ).encode("utf-8-sig")
+
+
+@em_cache_de_dados(cache=_cache_exportacoes)
+def exportar_excel(datas, **selecoes):
+    return converter_df_para_excel(ler_dados(datas, **selecoes))
+
+
+@em_cache_de_dados(cache=_cache_exportacoes)
+def exportar_csv(datas, **selecoes):
+    return converter_df_para_csv(ler_dados(datas, **selecoes))
+
+
+# Gráficos: a figura é montada a partir do agregado e guardada pelo conteúdo
+# dele, então o mesmo resultado (outra seleção, ou outra versão dos dados
+# com os mesmos números) reaproveita a figura pronta
+@st.cache_resource
+def _cache_figuras():
+    return CacheDados(max_entradas=32)
+
+
+def _assinatura(valor):
+    """Hash do conteúdo de um agregado (DataFrame ou valores simples)."""
+    if isinstance(valor, pd.DataFrame):
+        h = hashlib.sha1(pd.util.hash_pandas_object(valor, index=False).values)
+        h.update(repr(list(valor.columns)).encode())
+        return h.hexdigest()
+    return repr(valor)
+
+
+def figura_em_cache(func):
+    """Guarda a figura montada por `func` pelo conteúdo dos argumentos.
+
+    A versão é fixa: o conteúdo já identifica a figura, e o CacheDados
+    funciona como um LRU simples. As figuras são compartilhadas entre as
+    sessões: não altere a figura devolvida.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        chave = (func.__name__, *map(_assinatura, args))
+        return _cache_figuras().obter(0, chave, lambda: func(*args))
+
+    return wrapper
+
+
+@st.cache_resource
+def _tema_graficos():
+    """Registra o template "fazenda", com o estilo comum dos gráficos.
+
+    O plotly só é importado aqui, com o primeiro gráfico do processo.
+    """
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    pio.templates["fazenda"] = go.layout.Template(
+        layout=dict(
+            plot_bgcolor="rgba(0,0,0,0)",
+            paper_bgcolor="rgba(0,0,0,0)",
+            showlegend=True,
+            legend=dict(orientation="h"),
+            hoverlabel=dict(
+                bgcolor="rgba(27, 67, 50, 0.92)",
+                font_size=13,
+                font_family="Inter",
+                font_color="#ffffff",
+                bordercolor="rgba(255,255,255,0.15)",
+            ),
+        )
+    )
+    return pio.templates["fazenda"]
+
+
+def _figura_base(fig):
+    """Aplica o template "fazenda" no layout da figura.
+
+    O tema do Streamlit reescreve o `layout.template` no navegador, então o
+    estilo comum entra no próprio layout.
+    """
+    return fig.update_layout(_tema_graficos().layout.to_plotly_json())
+
+
+@figura_em_cache
+def figura_ranking(df_rank):
+    """Produtividade (barras) e área (linha) por variedade."""
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    fig = _figura_base(make_subplots(specs=[[{"secondary_y": True}]]))
+
+    fig.add_trace(
+        go.Bar(
+            x=df_rank["variedade"],
+            y=df_rank["yield"],
+            name="Sacas/ha",
+            marker_color="#2D6A4F",
+            text=df_rank["yield"].round(0).astype(int),
+            textposition="outside",
+            hovertemplate="<b>%{x}</b><br>Produtividade: %{y:.1f} sc/ha<extra></extra>",
+        ),
+        secondary_y=False,
+    )
+
+    fig.add_trace(
+        go.Scatter(
+            x=df_rank["variedade"],
+            y=df_rank["hectares"],
+            name="Hectares",
+            mode="lines+markers+text",
+            line=dict(color="#DDA15E", width=3),
+            marker=dict(size=8, color="#DDA15E"),
+            text=df_rank["hectares"].round(1),
+            textposition="top center",
+            textfont=dict(color="#B07D3B", size=10),
+            hovertemplate="<b>%{x}</b><br>Área: %{y:.1f} ha<extra></extra>",
+        ),
+        secondary_y=True,
+    )
+
+    max_yield = df_rank["yield"].max() if not df_rank.empty else 100
+    fig.update_layout(
+        margin=dict(l=0, r=0, t=35, b=0),
+        height=420,
+        legend_y=-0.25,
+        clickmode="event+select",
+        xaxis=dict(type="category"),
+        bargap=0.3,
+    )
+    fig.update_yaxes(
+        title_text="Sacas / Hectare",
+        secondary_y=False,
+        range=[0, max_yield * 1.18],
+    )
+    fig.update_yaxes(title_text="Hectares", secondary_y=True)
+    return fig
+
+
+@figura_em_cache
+def figura_perdas(liq, desc):
+    """Rosca com o peso líquido e a quebra (desconto)."""
+    import plotly.graph_objects as go
+
+    fig = _figura_base(
+        go.Figure(
+            data=[
+                go.Pie(
+                    labels=["Líquido", "Quebra"],
+                    values=[liq, desc],
+                    hole=0.6,
+                    marker_colors=["#2D6A4F", "#C1121F"],
+                    textinfo="percent",
+                    hovertemplate="<b>%{label}</b><br>%{value:,.0f} kg<br>%{percent}<extra></extra>",
+                )
+            ]
+        )
+    )
+    fig.update_layout(margin=dict(l=0, r=0, t=0, b=0), height=350, legend_y=-0.2)
+    return fig
+
+
+@figura_em_cache
+def figura_evolucao(df_evo, escala):
+    """Barras empilhadas de toneladas por período e talhão."""
+    import plotly.express as px
+
+    _, _, dias_barra, formato = escala
+    # Maiores talhões primeiro; "Outros" por último
+    ordem = (
+        df_evo.groupby("talhao_limpo", observed=True)["toneladas"]
+        .sum()
+        .sort_values(ascending=False)
+        .index.tolist()
+    )
+    if "Outros" in ordem:
+        ordem.append(ordem.pop(ordem.index("Outros")))
+    ms_barra = dias_barra * 24 * 60 * 60 * 1000
+
+    fig = px.bar(
+        df_evo,
+        x="periodo",
+        y="toneladas",
+        color="talhao_limpo",
+        custom_data=["rotulo"],
+        category_orders={"talhao_limpo": ordem},
+        color_discrete_sequence=px.colors.qualitative.Set2,
+    )
+    _figura_base(fig).update_layout(
+        margin=dict(l=0, r=0, t=0, b=0),
+        height=350,
+        xaxis_title=None,
+        yaxis_title="Toneladas",
+        legend_y=-0.3,
+        xaxis=dict(type="date", tickformat=formato),
+    )
+    # Cada barra ocupa 80% do seu período, a partir do início dele
+    fig.update_traces(
+        width=0.8 * ms_barra,
+        offset=0.1 * ms_barra,
+        hovertemplate="<b>%{customdata[0]}</b><br>%{fullData.name}<br>%{y:.2f} ton<extra></extra>",
+    )
+    return fig
+
+
+# Tabelas: formatação e barras pela configuração das colunas, renderizadas
+# pelo navegador (sem Styler nem CSS por célula)
+LINHAS_POR_PAGINA = 100
+
+
+def _coluna_barra(rotulo, valores, formato, cor):
+    """Número com uma barra proporcional ao maior valor (no lugar do degradê)."""
+    maior = float(valores.max()) if len(valores) else 0.0
+    return st.column_config.ProgressColumn(
+        rotulo, format=formato, min_value=0.0, max_value=maior or 1.0, color=cor
+    )
+
+
+def _seletor_pagina(total, por_pagina, chave):
+    """Página escolhida (a partir de 1); o seletor só aparece se houver mais de uma."""
+    paginas = -(-total // por_pagina)
+    if paginas <= 1:
+        return 1
+    # A chave inclui o nº de páginas: outra seleção volta para a página 1
+    pagina = st.number_input(
+        "Página", min_value=1, max_value=paginas, value=1, key=f"{chave}_{paginas}"
+    )
+    inicio = (pagina - 1) * por_pagina
+    st.caption(f"Linhas {inicio + 1}–{min(inicio + por_pagina, total)} de {total}")
+    return pagina
+
+
+def _tabela(df, column_config, paginar=False, chave=None, **kwargs):
+    """st.dataframe com `column_config`; paginada, só a página vai ao navegador.
+
+    As barras usam o maior valor da tabela inteira, então as páginas são
+    comparáveis entre si.
+    """
+    if paginar:
+        pagina = _seletor_pagina(len(df), LINHAS_POR_PAGINA, chave)
+        inicio = (pagina - 1) * LINHAS_POR_PAGINA
+        df = df.iloc[inicio : inicio + LINHAS_POR_PAGINA]
+    st.dataframe(df, column_config=column_config, **kwargs)
+
+
 # --- 4. INTERFACE ---
 
-# Gatilho 1: ?update=true na URL → força sync parcial + limpa parâmetro
+# A sync roda em segundo plano: a página continua com os dados atuais e
+# recarrega sozinha quando a nova versão fica pronta.
+_versao_exibida = versao_dados()
+
+# Gatilho 1: ?update=true na URL → sync incremental + limpa parâmetro
 _params = st.query_params
 if _params.get("update") == "true":
-    st.cache_data.clear()
-    sincronizar_dados("parcial")
+    iniciar_sync_em_segundo_plano("incremental")
     del _params["update"]
-    st.rerun()
 
-# Gatilho 2: auto-sync se a última sync é anterior às 06:00 de hoje (SP)
+# Gatilho 2: auto-sync se a última sync é anterior às 06:00 mais recentes (SP)
 if precisa_sincronizar():
-    sincronizar_dados("parcial")
-    st.rerun()
-
-df_clean = ler_dados()
+    iniciar_sync_em_segundo_plano("parcial")
+
+
+def _painel_sync():
+    """Progresso da sync em andamento, ou o resultado da última."""
+    estado = estado_sync()
+    if estado["rodando"]:
+        st.progress(estado["progresso"], text=estado["mensagem"])
+        return
+    if versao_dados() != _versao_exibida or st.session_state.get("_sync_rodando"):
+        # Terminou enquanto esta página estava aberta: recarrega com os dados novos
+        st.session_state["_sync_rodando"] = False
+        st.rerun(scope="app")
+    if estado["sucesso"] is True:
+        st.caption(f"✅ {estado['mensagem']}")
+    elif estado["sucesso"] is False:
+        st.caption(f"⚠️ {estado['mensagem']}")
 
 # ── SIDEBAR: Painel de Controle ──
 with st.sidebar:
@@ -529,11 +1023,8 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("#### 🔄 Sincronização")
 
-    try:
-        _db_mtime = os.path.getmtime(DB_FILE)
-        _last_update = datetime.fromtimestamp(_db_mtime, tz=FUSO_SP).strftime("%d/%m/%Y %H:%M")
-    except Exception:
-        _last_update = "—"
+    _ultima = ultima_sincronizacao()
+    _last_update = _ultima.strftime("%d/%m/%Y %H:%M") if _ultima else "—"
 
     st.markdown(
         f'<div class="sync-bar">'
@@ -546,15 +1037,21 @@ with st.sidebar:
     _btn1, _btn2 = st.columns(2)
     with _btn1:
         if st.button("🔄 Atualizar Mês", use_container_width=True):
-            sincronizar_dados("parcial")
-            st.rerun()
+            iniciar_sync_em_segundo_plano("parcial")
     with _btn2:
         if st.button("⚠️ Atualizar Tudo", use_container_width=True):
-            sincronizar_dados("total")
-            st.rerun()
+            iniciar_sync_em_segundo_plano("total")
 
-    if df_clean.empty:
+    # Só fica consultando o banco enquanto há uma sync rodando
+    _sync_rodando = estado_sync()["rodando"]
+    if _sync_rodando:
+        st.session_state["_sync_rodando"] = True
+    st.fragment(_painel_sync, run_every=2 if _sync_rodando else None)()
+
+    limites = limites_datas()
+    if limites is None:
         st.warning("⚠️ Banco vazio. Clique em Atualizar.")
+        _registrar_execucao()
         st.stop()
 
     # ── Filtros Hierárquicos (Cascata) ──
@@ -563,31 +1060,52 @@ with st.sidebar:
     st.caption("Os filtros são encadeados: cada seleção refina o próximo.")
 
     # 1. Filtro DATA (Mestre)
-    d_min, d_max = df_clean["data"].min().date(), df_clean["data"].max().date()
+    d_min, d_max = limites
     datas = st.slider("Período", d_min, d_max, (d_min, d_max), format="DD/MM/YYYY")
-    df_1 = df_clean[
-        (df_clean["data"].dt.date >= datas[0]) & (df_clean["data"].dt.date <= datas[1])
-    ]
 
     # 2. Filtro CULTURA (Depende da Data)
-    opcoes_cultura = sorted(df_1["cultura"].fillna("N/D").unique())
-    sel_cultura = st.multiselect("Cultura", options=opcoes_cultura)
-    df_2 = df_1[df_1["cultura"].isin(sel_cultura)] if sel_cultura else df_1
+    opcoes_cultura = opcoes_filtro("cultura", datas)
+    sel_cultura = tuple(st.multiselect("Cultura", options=opcoes_cultura))
 
     # 3. Filtro SAFRA (Depende da Cultura)
-    opcoes_safra = sorted(df_2["safra_agricola"].unique())
-    sel_safra = st.multiselect("Safra Agrícola", options=opcoes_safra)
-    df_3 = df_2[df_2["safra_agricola"].isin(sel_safra)] if sel_safra else df_2
+    opcoes_safra = opcoes_filtro("safra_agricola", datas, cultura=sel_cultura)
+    sel_safra = tuple(st.multiselect("Safra Agrícola", options=opcoes_safra))
 
     # 4. Filtro ÁREA/TALHÃO (Depende da Safra)
-    opcoes_area = sorted(df_3["talhao_limpo"].unique())
-    sel_area = st.multiselect("Área (Talhão)", options=opcoes_area)
-    df_4 = df_3[df_3["talhao_limpo"].isin(sel_area)] if sel_area else df_3
+    opcoes_area = opcoes_filtro(
+        "talhao_limpo", datas, cultura=sel_cultura, safra_agricola=sel_safra
+    )
+    sel_area = tuple(st.multiselect("Área (Talhão)", options=opcoes_area))
 
     # 5. Filtro VARIEDADE (Depende da Área)
-    opcoes_var = sorted(df_4["variedade"].unique())
-    sel_variedade = st.multiselect("Variedade", options=opcoes_var)
-    df_view = df_4[df_4["variedade"].isin(sel_variedade)] if sel_variedade else df_4
+    opcoes_var = opcoes_filtro(
+        "variedade",
+        datas,
+        cultura=sel_cultura,
+        safra_agricola=sel_safra,
+        talhao_limpo=sel_area,
+    )
+    sel_variedade = tuple(st.multiselect("Variedade", options=opcoes_var))
+
+    # Só as linhas da seleção saem do banco
+    selecoes = dict(
+        cultura=sel_cultura,
+        safra_agricola=sel_safra,
+        talhao_limpo=sel_area,
+        variedade=sel_variedade,
+    )
+    try:
+        df_view = ler_dados(datas, **selecoes)
+    except sqlite3.Error:
+        # Ex.: banco travado por uma sync. Erro não entra no cache de dados,
+        # então a próxima execução lê de novo
+        log.exception("Falha ao ler a seleção do banco")
+        df_view = pd.DataFrame()
+    log.debug(
+        "Cache de dados: %s; seleções: %s",
+        _cache_dados().estatisticas(),
+        _cache_selecoes().estatisticas(),
+    )
 
     # Detecta se algum filtro foi selecionado
     filtros_ativos = bool(sel_cultura or sel_safra or sel_area or sel_variedade)
@@ -595,17 +1113,31 @@ with st.sidebar:
     # ── Exportação ──
     st.markdown("---")
     if not df_view.empty:
-        excel_data = converter_df_para_excel(df_view)
-        st.download_button(
-            label="📥 Baixar Excel",
-            data=excel_data,
-            file_name=f'relatorio_filtrado_{datetime.now(FUSO_SP).strftime("%d_%m_%Y")}.xlsx',
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True,
-        )
+        # Os arquivos só são montados no clique (em outra thread, sem rerun)
+        _arquivo = f'relatorio_filtrado_{datetime.now(FUSO_SP).strftime("%d_%m_%Y")}'
+        if len(df_view) <= LINHAS_MAX_EXCEL:
+            st.download_button(
+                label="📥 Baixar Excel",
+                data=functools.partial(exportar_excel, datas, **selecoes),
+                file_name=f"{_arquivo}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",
+                use_container_width=True,
+            )
+        if len(df_view) > LINHAS_CSV:
+            st.download_button(
+                label="📄 Baixar CSV",
+                data=functools.partial(exportar_csv, datas, **selecoes),
+                file_name=f"{_arquivo}.csv",
+                mime="text/csv",
+                on_click="ignore",
+                use_container_width=True,
+            )
+            st.caption("Seleção grande: o CSV fica pronto bem mais rápido que o Excel.")
 
 if df_view.empty:
     st.warning("🚜 Nenhum dado encontrado para esta combinação de filtros. Tente alterar a data ou a área.")
+    _registrar_execucao()
     st.stop()
 
 # --- VISÃO PADRÃO: ROMANEIOS RECENTES (quando nenhum filtro selecionado) ---
@@ -614,312 +1146,139 @@ if not filtros_ativos:
         '<div class="chart-header">📋 Romaneios Recentes</div>',
         unsafe_allow_html=True,
     )
-    df_recentes = (
-        df_view.sort_values("data", ascending=False)
-        .head(50)
-        .copy()
+    _pagina = _seletor_pagina(
+        qtd_cargas(datas, (), **selecoes), LINHAS_TOP, "pagina_recentes"
     )
-    df_recentes["data"] = df_recentes["data"].dt.strftime("%d/%m/%Y")
-    _df_rec_styled = df_recentes[
-        [
-            "data",
-            "numero_romaneio",
-            "talhao_limpo",
-            "cultura",
-            "variedade",
-            "peso_liquido",
-            "sacas",
-        ]
-    ].rename(columns={
-        "data": "Data",
-        "numero_romaneio": "Romaneio",
-        "talhao_limpo": "Área",
-        "cultura": "Cultura",
-        "variedade": "Variedade",
-        "peso_liquido": "Peso Líq. (kg)",
-        "sacas": "Sacas",
-    })
-    try:
-        # NOTA: background_gradient requer matplotlib (ver requirements.txt)
-        _styled_rec = _df_rec_styled.style.format(
-            {"Peso Líq. (kg)": "{:,.0f}", "Sacas": "{:,.1f}"}
-        ).background_gradient(subset=["Sacas"], cmap="Greens")
-    except ImportError:
-        _styled_rec = _df_rec_styled.style.format(
-            {"Peso Líq. (kg)": "{:,.0f}", "Sacas": "{:,.1f}"}
-        )
-    st.dataframe(_styled_rec, use_container_width=True, height=500)
+    df_recentes = romaneios_recentes(datas, _pagina, **selecoes)
+    _tabela(
+        df_recentes,
+        {
+            "data": st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+            "numero_romaneio": "Romaneio",
+            "talhao_limpo": "Área",
+            "cultura": "Cultura",
+            "variedade": "Variedade",
+            "peso_liquido": st.column_config.NumberColumn(
+                "Peso Líq. (kg)", format="%,.0f"
+            ),
+            "sacas": _coluna_barra("Sacas", df_recentes["sacas"], "%,.1f", "green"),
+        },
+        use_container_width=True,
+        height=500,
+    )
+    _registrar_execucao()
     st.stop()
 
+# Indicadores, gráficos e detalhamento agregam o resumo diário, não os
+# romaneios, e ficam em cache por seleção: voltar a uma seleção é imediato
+
 # --- KPI GERAL ---
 try:
-    df_kpi_area = (
-        df_view.groupby(["safra_agricola", "local_safra", "cultura", "produto_full"])
-        .agg({"hectares": "max"})
-        .reset_index()
-    )
-    tot_ha = df_kpi_area["hectares"].sum()
-    tot_sacas = df_view["sacas"].sum()
-    prod_geral = tot_sacas / tot_ha if tot_ha > 0 else 0
-    tot_liq_ton = df_view["peso_liquido"].sum() / 1000
+    kpi = indicadores(datas, **selecoes)
 
     k1, k2, k3, k4 = st.columns(4)
-    k1.metric("Produtividade", f"{prod_geral:.1f} sc/ha")
-    k2.metric("Total Colhido", f"{tot_sacas:,.0f} sc")
-    k3.metric("Área Colhida", f"{tot_ha:,.1f} ha")
-    k4.metric("Volume Líquido", f"{tot_liq_ton:,.1f} ton")
+    k1.metric("Produtividade", f"{kpi['produtividade']:.1f} sc/ha")
+    k2.metric("Total Colhido", f"{kpi['sacas']:,.0f} sc")
+    k3.metric("Área Colhida", f"{kpi['hectares']:,.1f} ha")
+    k4.metric("Volume Líquido", f"{kpi['toneladas']:,.1f} ton")
 except Exception:
     st.error("⚠️ Ocorreu um erro ao calcular os indicadores. Por favor, ajuste os filtros.")
 
 st.markdown("<br>", unsafe_allow_html=True)
 
 # === GRÁFICOS ===
-try:
-    c_g1, c_g2 = st.columns([2, 1])
-
-    # PREPARA DADOS
-    df_var_area = (
-        df_view.groupby(["cultura", "variedade", "produto_full", "local_safra"])["hectares"]
-        .max()
-        .reset_index()
-    )
-    df_var_area_sum = (
-        df_var_area.groupby(["cultura", "variedade"])["hectares"].sum().reset_index()
-    )
+# Num fragmento: clicar numa barra do ranking refaz só os gráficos e as
+# tabelas, não a sidebar nem os indicadores
+def _painel_graficos(datas, selecoes):
+    try:
+        c_g1, c_g2 = st.columns([2, 1])
+
+        # GRÁFICO 1
+        with c_g1:
+            with st.container():
+                st.markdown(
+                    '<div class="chart-header">🏆 Eficiência por Variedade (Média Real)</div>',
+                    unsafe_allow_html=True,
+                )
+                fig_rank = figura_ranking(ranking_variedades(datas, **selecoes))
+                selection = st.plotly_chart(
+                    fig_rank, use_container_width=True, on_select="rerun"
+                )
 
-    talhoes_validos = df_var_area["local_safra"].unique()
-    df_sacas_validas = df_view[df_view["local_safra"].isin(talhoes_validos)]
-    df_var_sacas_sum = (
-        df_sacas_validas.groupby(["cultura", "variedade"])["sacas"].sum().reset_index()
-    )
+        # INTERATIVIDADE
+        destaque = ()
+        if selection and selection.get("selection") and selection["selection"].get("points"):
+            selected_points = selection["selection"]["points"]
+            destaque = tuple(p["x"] for p in selected_points)
+
+        # GRÁFICO 2
+        with c_g2:
+            with st.container():
+                st.markdown(
+                    '<div class="chart-header">📉 Qualidade (Perdas)</div>',
+                    unsafe_allow_html=True,
+                )
+                fig_pie = figura_perdas(*perdas(datas, destaque, **selecoes))
+                st.plotly_chart(fig_pie, use_container_width=True)
 
-    df_rank = pd.merge(df_var_sacas_sum, df_var_area_sum, on=["cultura", "variedade"])
-    df_rank["yield"] = df_rank["sacas"] / df_rank["hectares"]
-    df_rank = df_rank.sort_values("yield", ascending=False)
+        st.markdown("<hr class='section-divider'>", unsafe_allow_html=True)
 
-    # GRÁFICO 1
-    with c_g1:
+        # --- GRÁFICO DE EVOLUÇÃO ---
+        escala = escala_evolucao(datas)
+        st.markdown(
+            f'<div class="chart-header">📅 Evolução {escala[1]} '
+            "(Toneladas por Talhão)</div>",
+            unsafe_allow_html=True,
+        )
         with st.container():
-            st.markdown(
-                '<div class="chart-header">🏆 Eficiência por Variedade (Média Real)</div>',
-                unsafe_allow_html=True,
-            )
-
-            from plotly.subplots import make_subplots
-
-            fig_rank = make_subplots(specs=[[{"secondary_y": True}]])
-
-            fig_rank.add_trace(
-                go.Bar(
-                    x=df_rank["variedade"],
-                    y=df_rank["yield"],
-                    name="Sacas/ha",
-                    marker_color="#2D6A4F",
-                    text=df_rank["yield"].round(0).astype(int),
-                    textposition="outside",
-                    hovertemplate="<b>%{x}</b><br>Produtividade: %{y:.1f} sc/ha<extra></extra>",
+            df_evo = evolucao_talhoes(datas, destaque, **selecoes)
+            st.plotly_chart(figura_evolucao(df_evo, escala), use_container_width=True)
+
+        st.markdown("<hr class='section-divider'>", unsafe_allow_html=True)
+
+        # --- TABELAS ---
+        st.markdown("### 📋 Detalhamento")
+
+        df_tab_display = detalhamento(datas, destaque, **selecoes)
+        _tabela(
+            df_tab_display,
+            {
+                "sacas": st.column_config.NumberColumn(format="%,.1f"),
+                "hectares": st.column_config.NumberColumn(format="%,.2f"),
+                "produtividade": _coluna_barra(
+                    "produtividade", df_tab_display["produtividade"], "%,.2f", "green"
                 ),
-                secondary_y=False,
-            )
-
-            fig_rank.add_trace(
-                go.Scatter(
-                    x=df_rank["variedade"],
-                    y=df_rank["hectares"],
-                    name="Hectares",
-                    mode="lines+markers+text",
-                    line=dict(color="#DDA15E", width=3),
-                    marker=dict(size=8, color="#DDA15E"),
-                    text=df_rank["hectares"].round(1),
-                    textposition="top center",
-                    textfont=dict(color="#B07D3B", size=10),
-                    hovertemplate="<b>%{x}</b><br>Área: %{y:.1f} ha<extra></extra>",
-                ),
-                secondary_y=True,
-            )
-
-            max_yield = df_rank["yield"].max() if not df_rank.empty else 100
-            fig_rank.update_layout(
-                margin=dict(l=0, r=0, t=35, b=0),
-                height=420,
-                showlegend=True,
-                legend=dict(orientation="h", y=-0.25),
-                plot_bgcolor="rgba(0,0,0,0)",
-                paper_bgcolor="rgba(0,0,0,0)",
-                clickmode="event+select",
-                xaxis=dict(type="category"),
-                bargap=0.3,
-                hoverlabel=dict(
-                    bgcolor="rgba(27, 67, 50, 0.92)",
-                    font_size=13,
-                    font_family="Inter",
-                    font_color="#ffffff",
-                    bordercolor="rgba(255,255,255,0.15)",
-                ),
-            )
-            fig_rank.update_yaxes(
-                title_text="Sacas / Hectare",
-                secondary_y=False,
-                range=[0, max_yield * 1.18],
-            )
-            fig_rank.update_yaxes(title_text="Hectares", secondary_y=True)
-
-            selection = st.plotly_chart(
-                fig_rank, use_container_width=True, on_select="rerun"
-            )
-
-    # INTERATIVIDADE
-    df_interactive = df_view.copy()
-    if selection and selection.get("selection") and selection["selection"].get("points"):
-        selected_points = selection["selection"]["points"]
-        selected_varieties = [p["x"] for p in selected_points]
-        if selected_varieties:
-            df_interactive = df_view[df_view["variedade"].isin(selected_varieties)]
+            },
+            paginar=True,
+            chave="pagina_detalhamento",
+            use_container_width=True,
+            height=400,
+        )
 
-    # GRÁFICO 2
-    with c_g2:
-        with st.container():
+        # --- AUDITORIA ---
+        with st.expander("🕵️ Auditoria de Maiores Cargas"):
             st.markdown(
-                '<div class="chart-header">📉 Qualidade (Perdas)</div>',
-                unsafe_allow_html=True,
+                f"As maiores cargas, {LINHAS_TOP} por página "
+                "(útil para achar devoluções ou duplicidades)."
             )
-            liq = df_interactive["peso_liquido"].sum()
-            desc = df_interactive["desconto"].sum()
-
-            fig_pie = go.Figure(
-                data=[
-                    go.Pie(
-                        labels=["Líquido", "Quebra"],
-                        values=[liq, desc],
-                        hole=0.6,
-                        marker_colors=["#2D6A4F", "#C1121F"],
-                        textinfo="percent",
-                        hovertemplate="<b>%{label}</b><br>%{value:,.0f} kg<br>%{percent}<extra></extra>",
-                    )
-                ]
+            _pagina = _seletor_pagina(
+                qtd_cargas(datas, destaque, **selecoes), LINHAS_TOP, "pagina_auditoria"
             )
-            fig_pie.update_layout(
-                margin=dict(l=0, r=0, t=0, b=0),
-                height=350,
-                showlegend=True,
-                legend=dict(orientation="h", y=-0.2),
-                plot_bgcolor="rgba(0,0,0,0)",
-                paper_bgcolor="rgba(0,0,0,0)",
-                hoverlabel=dict(
-                    bgcolor="rgba(27, 67, 50, 0.92)",
-                    font_size=13,
-                    font_family="Inter",
-                    font_color="#ffffff",
-                    bordercolor="rgba(255,255,255,0.15)",
-                ),
+            _df_audit = maiores_cargas(datas, destaque, _pagina, **selecoes)
+            _tabela(
+                _df_audit,
+                {
+                    "data": st.column_config.DateColumn(format="DD/MM/YYYY"),
+                    "sacas": _coluna_barra("sacas", _df_audit["sacas"], "%,.1f", "red"),
+                    "hectares": st.column_config.NumberColumn(format="%,.2f"),
+                },
+                use_container_width=True,
             )
-            st.plotly_chart(fig_pie, use_container_width=True)
-
-    st.markdown("<hr class='section-divider'>", unsafe_allow_html=True)
 
-    # --- GRÁFICO DE EVOLUÇÃO ---
-    st.markdown(
-        '<div class="chart-header">📅 Evolução Diária (Toneladas por Talhão)</div>',
-        unsafe_allow_html=True,
-    )
-    with st.container():
-        df_evo_prep = df_interactive.copy()
-        df_evo_prep["data_only"] = df_evo_prep["data"].dt.strftime("%d/%m/%Y")
-        df_evo_prep["toneladas"] = df_evo_prep["peso_liquido"] / 1000
-
-        df_evo = (
-            df_evo_prep.groupby(["data_only", "talhao_limpo"])["toneladas"]
-            .sum()
-            .reset_index()
-        )
-        # Ordenar por data real
-        df_evo["_sort"] = pd.to_datetime(df_evo["data_only"], format="%d/%m/%Y")
-        df_evo = df_evo.sort_values("_sort").drop(columns="_sort")
-
-        fig_evo = px.bar(
-            df_evo,
-            x="data_only",
-            y="toneladas",
-            color="talhao_limpo",
-            color_discrete_sequence=px.colors.qualitative.Set2,
-        )
-        fig_evo.update_layout(
-            margin=dict(l=0, r=0, t=0, b=0),
-            height=350,
-            xaxis_title=None,
-            yaxis_title="Toneladas",
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="rgba(0,0,0,0)",
-            bargap=0.2,
-            showlegend=True,
-            legend=dict(orientation="h", y=-0.3),
-            xaxis=dict(type="category"),
-            hoverlabel=dict(
-                bgcolor="rgba(27, 67, 50, 0.92)",
-                font_size=13,
-                font_family="Inter",
-                font_color="#ffffff",
-                bordercolor="rgba(255,255,255,0.15)",
-            ),
-        )
-        fig_evo.update_traces(
-            hovertemplate="<b>%{x}</b><br>%{fullData.name}<br>%{y:.2f} ton<extra></extra>"
-        )
-        st.plotly_chart(fig_evo, use_container_width=True)
-
-    st.markdown("<hr class='section-divider'>", unsafe_allow_html=True)
-
-    # --- TABELAS ---
-    st.markdown("### 📋 Detalhamento")
+    except Exception:
+        st.error("⚠️ Ocorreu um erro ao processar esta visualização. Por favor, ajuste os filtros.")
 
-    df_tab_base = (
-        df_interactive.groupby(["safra_agricola", "local_safra", "cultura", "variedade", "produto_full"])
-        .agg({"hectares": "max", "sacas": "sum"})
-        .reset_index()
-    )
 
-    df_tab_base["produtividade"] = df_tab_base["sacas"] / df_tab_base["hectares"]
-    df_tab_base = df_tab_base[df_tab_base["produtividade"] <= 2000]
+st.fragment(_painel_graficos)(datas, selecoes)
 
-    df_tab_display = df_tab_base.sort_values("produtividade", ascending=False).copy()
-    try:
-        # NOTA: background_gradient requer matplotlib (ver requirements.txt)
-        _styled_tab = df_tab_display.style.format(
-            {"sacas": "{:,.1f}", "hectares": "{:,.2f}", "produtividade": "{:,.2f}"}
-        ).background_gradient(subset=["produtividade"], cmap="Greens")
-    except ImportError:
-        _styled_tab = df_tab_display.style.format(
-            {"sacas": "{:,.1f}", "hectares": "{:,.2f}", "produtividade": "{:,.2f}"}
-        )
-    st.dataframe(_styled_tab, use_container_width=True, height=400)
-
-    # --- AUDITORIA ---
-    with st.expander("🕵️ Auditoria de Maiores Cargas"):
-        st.markdown(
-            "Lista das 50 maiores cargas (útil para achar devoluções ou duplicidades)."
-        )
-        top_tickets = df_interactive.sort_values("sacas", ascending=False).head(50).copy()
-        top_tickets["data"] = top_tickets["data"].dt.strftime("%d/%m/%Y")
-        _df_audit = top_tickets[
-            [
-                "data",
-                "numero_romaneio",
-                "produto_full",
-                "sacas",
-                "hectares",
-                "obs",
-            ]
-        ]
-        try:
-            # NOTA: background_gradient requer matplotlib (ver requirements.txt)
-            _styled_audit = _df_audit.style.format(
-                {"sacas": "{:,.1f}", "hectares": "{:,.2f}"}
-            ).background_gradient(subset=["sacas"], cmap="Reds")
-        except ImportError:
-            _styled_audit = _df_audit.style.format(
-                {"sacas": "{:,.1f}", "hectares": "{:,.2f}"}
-            )
-        st.dataframe(_styled_audit, use_container_width=True)
-
-except Exception:
-    st.error("⚠️ Ocorreu um erro ao processar esta visualização. Por favor, ajuste os filtros.")
\ No newline at end of file
+_registrar_execucao()
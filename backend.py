@@ -0,0 +1,1620 @@
+"""Banco e sincronização com a API, sem depender do Streamlit.
+
+O dashboard (app.py) importa daqui; a sync também roda sozinha, por exemplo
+no cron antes das 06:00, a partir da pasta do app:
+
+    python -m backend sync --mode parcial
+
+O progresso vai para o stderr e o resumo, em JSON, para o stdout.
+"""
+import argparse
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# requests só é importado quando há sync (o dashboard abre sem ele)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # sem pyarrow a leitura vai direto ao SQLite
+    pa = None
+
+log = logging.getLogger("fpm")
+
+# --- 1. CONFIGURAÇÕES ---
+DB_FILE = "dados_fazenda.db"
+SNAPSHOT_DIR = "snapshot_produtividade"  # Parquet particionado por safra
+ARQUIVO_SECRETS = os.path.join(".streamlit", "secrets.toml")
+CHAVES_API = ("base_url", "cliente", "token", "auth_user", "auth_pass")
+
+# Fuso horário padrão — Streamlit Cloud roda em UTC
+FUSO_SP = pytz.timezone("America/Sao_Paulo")
+
+FILIAIS_ALVO = ["2", "5", "1"]
+ID_UNIDADE = "1"
+TIPO_TICKET = "Entrada Produção"
+
+ENDPOINTS_CADASTRO = [
+    "areas",
+    "subareas",
+    "anos",
+    "produtos",
+    "produtosnomes",
+    "produtosvariedades",
+]
+# Cadastros guardados no banco valem por esse tempo sem consultar a API;
+# depois são revalidados (If-None-Match/If-Modified-Since)
+CADASTRO_TTL = 6 * 60 * 60
+
+# Timeouts (conexão, leitura) em segundos — movimentações podem ser bem maiores
+TIMEOUT_PADRAO = (5, 30)
+TIMEOUTS_ENDPOINT = {
+    "ticketscompras": (5, 120),
+    "ticketscomprasitens": (5, 120),
+    "ticketscomprasdestinacoes": (5, 180),
+}
+MAX_TENTATIVAS = 3
+BACKOFF_SEG = 0.5  # dobra a cada nova tentativa
+STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+TAMANHO_PEDACO = 64 * 1024  # bytes lidos por vez nas respostas em streaming
+
+# "Atualizar Tudo": período dividido em janelas baixadas em paralelo
+DATA_INICIO_TOTAL = date(2020, 1, 1)
+JANELA_MESES = 1
+JANELA_WORKERS = 3
+JANELAS_EM_VOO = 2 * JANELA_WORKERS  # baixando ou esperando para gravar
+JANELA_TENTATIVAS = 2  # novas rodadas só para as janelas que falharam
+
+# Sync em segundo plano: a trava expira se a sync parar de dar sinal de vida
+SYNC_TRAVA_TTL = 15 * 60
+SYNC_PAUSA_APOS_FALHA = 10 * 60  # auto-sync não insiste antes disso
+
+PALAVRAS_PROIBIDAS = [
+    "FILTRO",
+    "OLEO",
+    "ÓLEO",
+    "PECA",
+    "PEÇA",
+    "PARAFUSO",
+    "ARRUELA",
+    "LUBRIFICANTE",
+    "ADUB",
+    "FERTILIZANTE",
+    "SEMENTE",
+    "DIESEL",
+    "ZETHA",
+    "HERBICIDA",
+    "FUNGICIDA",
+]
+
+# kg por saca, pela primeira cultura encontrada no nome do produto
+DIVISORES_CULTURA = {"BATATA": 50.0}
+DIVISOR_PADRAO = 60.0
+
+
+# --- 2. CREDENCIAIS DA API ---
+_config_api = None
+
+
+def configurar_api(config):
+    """Define as credenciais da API (o app passa st.secrets["api"])."""
+    global _config_api
+    faltando = [k for k in CHAVES_API if not config.get(k)]
+    if faltando:
+        raise KeyError(f"Credenciais da API incompletas: {', '.join(faltando)}")
+    _config_api = {k: config[k] for k in CHAVES_API}
+
+
+def _api():
+    """Credenciais da API. Fora do Streamlit vêm das variáveis FPM_API_*
+    (FPM_API_BASE_URL, FPM_API_TOKEN, ...) ou da seção [api] do secrets.toml."""
+    if _config_api is None:
+        config = {}
+        if os.path.exists(ARQUIVO_SECRETS):
+            import tomllib  # só aqui: no dashboard quem lê os secrets é o Streamlit
+
+            with open(ARQUIVO_SECRETS, "rb") as f:
+                config.update(tomllib.load(f).get("api", {}))
+        for chave in CHAVES_API:
+            valor = os.environ.get(f"FPM_API_{chave.upper()}")
+            if valor:
+                config[chave] = valor
+        configurar_api(config)
+    return _config_api
+
+
+# --- 3. BANCO E SINCRONIZAÇÃO ---
+COLUNAS_ANALISE = [
+    "id_ticket",
+    "data",
+    "numero_romaneio",
+    "local_safra",
+    "safra_agricola",
+    "produto_full",
+    "cultura",
+    "variedade",
+    "divisor",
+    "peso_bruto",
+    "desconto",
+    "peso_liquido",
+    "sacas",
+    "hectares",
+    "id_local_estoque",
+    "obs",
+    "talhao_limpo",
+]
+
+COLUNAS_NUMERICAS = [
+    "divisor",
+    "peso_bruto",
+    "desconto",
+    "peso_liquido",
+    "sacas",
+    "hectares",
+]
+
+# Colunas que o dashboard e a exportação usam (projeção na leitura)
+COLUNAS_LEITURA = [
+    c for c in COLUNAS_ANALISE if c not in ("id_ticket", "divisor", "id_local_estoque")
+]
+
+# Colunas de baixa cardinalidade: carregadas como category no pandas
+COLUNAS_CATEGORIA = [
+    "local_safra",
+    "safra_agricola",
+    "produto_full",
+    "cultura",
+    "variedade",
+    "talhao_limpo",
+]
+
+# Resumo diário mantido pela sync: uma linha por dia × talhão × produto, com
+# as somas e o maior hectares do dia. O dashboard agrega a partir dele.
+CHAVES_RESUMO = ["data", *COLUNAS_CATEGORIA]
+COLUNAS_RESUMO = [*CHAVES_RESUMO, "sacas", "peso_liquido", "desconto", "hectares"]
+
+SQL_RESUMO = f"""
+    INSERT INTO resumo_diario ({", ".join(COLUNAS_RESUMO)})
+    SELECT {", ".join(CHAVES_RESUMO)},
+        SUM(sacas), SUM(peso_liquido), SUM(desconto), MAX(hectares)
+    FROM analise_produtividade
+    WHERE {{where}}
+    GROUP BY {", ".join(CHAVES_RESUMO)}
+"""
+
+SQL_UPSERT_ANALISE = f"""
+    INSERT INTO analise_produtividade ({", ".join(COLUNAS_ANALISE)})
+    VALUES ({", ".join("?" for _ in COLUNAS_ANALISE)})
+    ON CONFLICT(id_ticket) DO UPDATE SET
+        {", ".join(f"{col} = excluded.{col}" for col in COLUNAS_ANALISE[1:])}
+"""
+
+
+RE_SUFIXO_SAFRA = re.compile(r"\s\(\d{2,4}.*\)")
+
+
+# Uma busca só no nome: em cada posição, palavra proibida tem preferência
+RE_PRODUTO = re.compile(
+    "(?=(?P<proibida>%s)|(?P<cultura>%s))"
+    % (
+        "|".join(map(re.escape, PALAVRAS_PROIBIDAS)),
+        "|".join(map(re.escape, DIVISORES_CULTURA)) or "(?!)",
+    )
+)
+
+
+@functools.lru_cache(maxsize=None)
+def classificar_produto(nome):
+    """(proibido, divisor) do produto pelo nome em maiúsculas.
+
+    Proibido se contiver alguma PALAVRAS_PROIBIDAS; o divisor vem de
+    DIVISORES_CULTURA, ou DIVISOR_PADRAO se nenhuma cultura aparecer.
+    """
+    divisor = None
+    for m in RE_PRODUTO.finditer(nome):
+        if m.group("proibida"):
+            return True, None
+        divisor = divisor or DIVISORES_CULTURA[m.group("cultura")]
+    return False, divisor or DIVISOR_PADRAO
+
+
+def _produto_proibido(nome):
+    """classificar_produto para o SQL, sem diferenciar maiúsculas."""
+    return nome is not None and classificar_produto(nome.upper())[0]
+
+
+def _talhao_limpo(local_safra):
+    """Nome do talhão sem o sufixo de safra: "FAZ - T1 (2023/2024)" → "FAZ - T1"."""
+    if local_safra is None:
+        return None
+    return RE_SUFIXO_SAFRA.sub("", local_safra)
+
+
+def _conectar():
+    """Abre o banco com WAL (leitores não bloqueiam a sync) e PRAGMAs de escrita."""
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")  # ~16 MB
+    return conn
+
+
+def _migracao_1(c):
+    """Schema base. Corrige bancos antigos sem perder o histórico."""
+    sql_criar = """
+        CREATE TABLE IF NOT EXISTS analise_produtividade (
+            id_ticket TEXT PRIMARY KEY, data TEXT, numero_romaneio TEXT,
+            local_safra TEXT, safra_agricola TEXT, produto_full TEXT,
+            cultura TEXT, variedade TEXT, divisor REAL, peso_bruto REAL,
+            desconto REAL, peso_liquido REAL, sacas REAL, hectares REAL,
+            id_local_estoque TEXT, obs TEXT
+        )
+    """
+    c.execute(sql_criar)
+    info = c.execute("PRAGMA table_info(analise_produtividade)").fetchall()
+
+    # Bancos anteriores à coluna obs: antes a tabela inteira era apagada
+    if "obs" not in [r[1] for r in info]:
+        c.execute("ALTER TABLE analise_produtividade ADD COLUMN obs TEXT DEFAULT ''")
+
+    # O antigo to_sql(if_exists="replace") recriava a tabela sem a chave
+    # primária: reconstrói com o schema declarado, mantendo uma linha por id
+    if [r[1] for r in info if r[5]] != ["id_ticket"]:
+        cols = ", ".join(COLUNAS_ANALISE[: COLUNAS_ANALISE.index("obs") + 1])
+        c.execute("ALTER TABLE analise_produtividade RENAME TO _analise_antiga")
+        c.execute(sql_criar)
+        c.execute(
+            f"""
+            INSERT OR REPLACE INTO analise_produtividade ({cols})
+            SELECT CAST(id_ticket AS TEXT), {cols.split(", ", 1)[1]}
+            FROM _analise_antiga ORDER BY rowid
+        """
+        )
+        c.execute("DROP TABLE _analise_antiga")
+
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_log (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ultima_sync TEXT
+        )
+    """
+    )
+    # Marca d'água por endpoint: última data/ID de ticket e hash dos cadastros
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_checkpoint (
+            endpoint TEXT PRIMARY KEY,
+            ultima_data TEXT,
+            ultimo_id TEXT,
+            hash TEXT,
+            atualizado_em TEXT
+        )
+    """
+    )
+
+
+def _migracao_2(c):
+    """Datas só como YYYY-MM-DD e índices para os filtros e a sync parcial."""
+    c.execute(
+        "UPDATE analise_produtividade SET data = substr(data, 1, 10) "
+        "WHERE length(data) > 10"
+    )
+    for col in ("data", "cultura", "safra_agricola", "local_safra"):
+        c.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_analise_{col} "
+            f"ON analise_produtividade ({col})"
+        )
+
+
+def _migracao_3(c):
+    """Limpeza feita uma vez no banco, e não mais a cada leitura.
+
+    Grava talhao_limpo como coluna, troca safra/cultura nulas por "N/D" e
+    remove o que a sync já não grava (produtos proibidos, sacas <= 0).
+    """
+    c.execute("ALTER TABLE analise_produtividade ADD COLUMN talhao_limpo TEXT")
+    c.execute(
+        "UPDATE analise_produtividade SET talhao_limpo = talhao_limpo(local_safra)"
+    )
+    c.execute(
+        "UPDATE analise_produtividade SET "
+        "safra_agricola = COALESCE(safra_agricola, 'N/D'), "
+        "cultura = COALESCE(cultura, 'N/D') "
+        "WHERE safra_agricola IS NULL OR cultura IS NULL"
+    )
+    # Mesma regra da sync: o nome completo (base e variedade) é classificado
+    c.execute(
+        "DELETE FROM analise_produtividade "
+        "WHERE sacas <= 0 OR produto_proibido(produto_full)"
+    )
+    for col in ("talhao_limpo", "variedade"):
+        c.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_analise_{col} "
+            f"ON analise_produtividade ({col})"
+        )
+
+
+def _migracao_4(c):
+    """Versão dos dados, incrementada a cada sync (chave do cache de leitura)."""
+    c.execute("ALTER TABLE sync_log ADD COLUMN versao INTEGER NOT NULL DEFAULT 0")
+
+
+def _migracao_5(c):
+    """Trava e progresso da sync, visíveis para todas as sessões e processos."""
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_execucao (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            dono TEXT,
+            modo TEXT,
+            inicio REAL,
+            expira REAL,
+            fim REAL,
+            progresso INTEGER,
+            mensagem TEXT,
+            sucesso INTEGER
+        )
+    """
+    )
+
+
+def _migracao_6(c):
+    """Cópia local dos cadastros, com o validador HTTP e o hash do conteúdo."""
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cadastro_cache (
+            endpoint TEXT PRIMARY KEY,
+            dados TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            validado_em REAL NOT NULL
+        )
+    """
+    )
+
+
+def _migracao_7(c):
+    """Resumo diário para os indicadores e tabelas do dashboard."""
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS resumo_diario (
+            data TEXT, local_safra TEXT, safra_agricola TEXT, produto_full TEXT,
+            cultura TEXT, variedade TEXT, talhao_limpo TEXT, sacas REAL,
+            peso_liquido REAL, desconto REAL, hectares REAL
+        )
+    """
+    )
+    for col in ("data", "safra_agricola"):
+        c.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_resumo_{col} ON resumo_diario ({col})"
+        )
+    atualizar_resumo(c)
+
+
+# Ordem importa: a posição na lista (a partir de 1) é a versão do schema,
+# gravada em PRAGMA user_version. Nunca altere uma migração já publicada.
+MIGRACOES = [
+    _migracao_1,
+    _migracao_2,
+    _migracao_3,
+    _migracao_4,
+    _migracao_5,
+    _migracao_6,
+    _migracao_7,
+]
+
+
+def init_db():
+    """Aplica, cada uma em sua transação, as migrações ainda não aplicadas."""
+    conn = _conectar()
+    conn.create_function("talhao_limpo", 1, _talhao_limpo, deterministic=True)
+    conn.create_function(
+        "produto_proibido", 1, _produto_proibido, deterministic=True
+    )
+    try:
+        versao = conn.execute("PRAGMA user_version").fetchone()[0]
+        for numero, migracao in enumerate(MIGRACOES[versao:], start=versao + 1):
+            with conn:
+                conn.execute("BEGIN")
+                migracao(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {numero}")
+            log.info("Banco migrado para a versão %d", numero)
+        if not os.path.isdir(SNAPSHOT_DIR):
+            atualizar_snapshot(conn)
+    finally:
+        conn.close()
+
+
+@functools.cache
+def _sessao_http():
+    """Sessão HTTP única do processo: keep-alive e pool de conexões."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.auth import HTTPBasicAuth
+
+    api = _api()
+    sessao = requests.Session()
+    sessao.auth = HTTPBasicAuth(api["auth_user"], api["auth_pass"])
+    adaptador = HTTPAdapter(
+        pool_connections=len(ENDPOINTS_CADASTRO), pool_maxsize=len(ENDPOINTS_CADASTRO)
+    )
+    sessao.mount("http://", adaptador)
+    sessao.mount("https://", adaptador)
+    return sessao
+
+
+class ErroAPI(Exception):
+    """Falha definitiva ao baixar um endpoint (após todas as tentativas)."""
+
+
+def _url(endpoint, d_ini=None, d_fim=None):
+    api = _api()
+    base, cliente, token = api["base_url"], api["cliente"], api["token"]
+    if d_ini and d_fim:
+        return f"{base}/{endpoint}/{d_ini}/{d_fim}/{cliente}/{token}"
+    return f"{base}/{endpoint}/{cliente}/{token}"
+
+
+def _requisitar(endpoint, url, sessao, stream=False, cabecalhos=None):
+    """GET com timeout por endpoint e novas tentativas com backoff.
+
+    Com cabeçalhos condicionais, a resposta pode ser 304 (não mudou).
+    """
+    import requests
+
+    timeout = TIMEOUTS_ENDPOINT.get(endpoint, TIMEOUT_PADRAO)
+    for tentativa in range(1, MAX_TENTATIVAS + 1):
+        try:
+            r = sessao.get(url, timeout=timeout, stream=stream, headers=cabecalhos)
+            if r.status_code in (200, 304):
+                return r
+            r.close()
+            if r.status_code not in STATUS_RETENTAVEIS:
+                raise ErroAPI(f"{endpoint}: HTTP {r.status_code}")
+        except requests.RequestException:
+            pass
+        if tentativa < MAX_TENTATIVAS:
+            time.sleep(BACKOFF_SEG * 2 ** (tentativa - 1))
+    raise ErroAPI(f"{endpoint}: sem resposta após {MAX_TENTATIVAS} tentativas")
+
+
+def _itens_array_json(pedacos):
+    """Decodifica um array JSON aos poucos, devolvendo um elemento por vez."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    abriu = False
+    for pedaco in pedacos:
+        buf = buf[pos:] + pedaco
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not abriu:
+                if buf[pos] != "[":
+                    raise ValueError("resposta não é um array JSON")
+                abriu = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, fim = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # elemento incompleto: espera o próximo pedaço
+            if not isinstance(item, (dict, list)):
+                # Número/literal pode continuar no próximo pedaço ("12." + "5"):
+                # só está completo quando vem a vírgula ou o "]" depois dele
+                seguinte = fim
+                while seguinte < len(buf) and buf[seguinte] in " \t\r\n":
+                    seguinte += 1
+                if seguinte == len(buf) or buf[seguinte] not in ",]":
+                    break
+            yield item
+            pos = fim
+    raise ValueError("array JSON incompleto")
+
+
+def iterar_json(endpoint, d_ini=None, d_fim=None, sessao=None, tempos=None):
+    """Baixa um endpoint em streaming e devolve os itens do array um a um.
+
+    A resposta nunca fica inteira em memória. Levanta ErroAPI se o download
+    falhar, inclusive no meio do corpo.
+    """
+    import requests
+
+    sessao = sessao or _sessao_http()
+    inicio = time.perf_counter()
+    n = 0
+    try:
+        with _requisitar(
+            endpoint, _url(endpoint, d_ini, d_fim), sessao, stream=True
+        ) as r:
+            r.encoding = r.encoding or "utf-8"
+            pedacos = r.iter_content(TAMANHO_PEDACO, decode_unicode=True)
+            for item in _itens_array_json(pedacos):
+                n += 1
+                yield item
+    except (requests.RequestException, ValueError) as e:
+        raise ErroAPI(f"{endpoint}: {e}") from e
+    finally:
+        decorrido = time.perf_counter() - inicio
+        log.info("%s: %d registros em %.2fs (stream)", endpoint, n, decorrido)
+        if tempos is not None:
+            tempos[endpoint] = decorrido
+
+
+def _ler_cadastros(conn):
+    """Metadados da cópia local de cada cadastro (sem o conteúdo)."""
+    return {
+        ep: {"hash": h, "etag": etag, "last_modified": lm, "validado_em": em}
+        for ep, h, etag, lm, em in conn.execute(
+            "SELECT endpoint, hash, etag, last_modified, validado_em "
+            "FROM cadastro_cache"
+        )
+    }
+
+
+def _baixar_cadastro(endpoint, guardado, sessao, tempos):
+    """Baixa um cadastro condicionado ao validador HTTP da cópia local.
+
+    Devolve (dados, etag, last_modified), ou None se a API responder 304.
+    """
+    cabecalhos = {}
+    if guardado and guardado["etag"]:
+        cabecalhos["If-None-Match"] = guardado["etag"]
+    if guardado and guardado["last_modified"]:
+        cabecalhos["If-Modified-Since"] = guardado["last_modified"]
+    inicio = time.perf_counter()
+    resposta = None
+    try:
+        r = _requisitar(endpoint, _url(endpoint), sessao, cabecalhos=cabecalhos)
+        if r.status_code != 304:
+            resposta = (r.json(), r.headers.get("ETag"), r.headers.get("Last-Modified"))
+    except ValueError as e:
+        raise ErroAPI(f"{endpoint}: {e}") from e
+    finally:
+        decorrido = time.perf_counter() - inicio
+        if resposta is None:
+            log.info("%s: sem alteração em %.2fs", endpoint, decorrido)
+        else:
+            log.info("%s: %d registros em %.2fs", endpoint, len(resposta[0]), decorrido)
+        if tempos is not None:
+            tempos[endpoint] = decorrido
+    return resposta
+
+
+def atualizar_cadastros(tempos=None, sessao=None, forcar=False):
+    """Revalida na API os cadastros vencidos e devolve o hash de cada um.
+
+    A cópia local vale por CADASTRO_TTL sem nenhuma requisição (a menos que
+    `forcar`); vencida, é baixada de novo em paralelo, com requisição
+    condicional. Se a API falhar, segue com a cópia local; levanta ErroAPI
+    só se não houver cópia: sem o cadastro as movimentações seriam todas
+    descartadas e o período apagado do banco.
+    """
+    conn = _conectar()
+    try:
+        guardados = _ler_cadastros(conn)
+        agora = time.time()
+        vencidos = [
+            ep
+            for ep in ENDPOINTS_CADASTRO
+            if forcar
+            or ep not in guardados
+            or agora - guardados[ep]["validado_em"] >= CADASTRO_TTL
+        ]
+        respostas = {}
+        if vencidos:
+            sessao = sessao or _sessao_http()
+            with ThreadPoolExecutor(max_workers=len(vencidos)) as pool:
+                futuros = {
+                    ep: pool.submit(
+                        _baixar_cadastro, ep, guardados.get(ep), sessao, tempos
+                    )
+                    for ep in vencidos
+                }
+                for ep, futuro in futuros.items():
+                    try:
+                        respostas[ep] = futuro.result()
+                    except ErroAPI as e:
+                        if ep not in guardados:
+                            raise
+                        log.warning("%s; usando a cópia local", e)
+
+        with conn:
+            for ep, resposta in respostas.items():
+                if resposta is None:
+                    conn.execute(
+                        "UPDATE cadastro_cache SET validado_em = ? WHERE endpoint = ?",
+                        (agora, ep),
+                    )
+                    continue
+                dados, etag, last_modified = resposta
+                guardados[ep] = {"hash": _hash_json(dados)}
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO cadastro_cache
+                        (endpoint, dados, hash, etag, last_modified, validado_em)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                    (
+                        ep,
+                        json.dumps(dados),
+                        guardados[ep]["hash"],
+                        etag,
+                        last_modified,
+                        agora,
+                    ),
+                )
+    finally:
+        conn.close()
+    log.info(
+        "Cadastros: %d de %d revalidados na API",
+        len(respostas),
+        len(ENDPOINTS_CADASTRO),
+    )
+    return {ep: guardados[ep]["hash"] for ep in ENDPOINTS_CADASTRO}
+
+
+@functools.lru_cache(maxsize=1)
+def _catalogos_por_hash(hashes):
+    """Catálogos montados da cópia local; só remonta quando um hash muda."""
+    conn = _conectar()
+    try:
+        cadastros = {
+            ep: json.loads(dados)
+            for ep, dados in conn.execute("SELECT endpoint, dados FROM cadastro_cache")
+        }
+    finally:
+        conn.close()
+    return _montar_catalogos(cadastros)
+
+
+def carregar_catalogos(tempos=None, sessao=None, forcar=False):
+    """Catálogos prontos para a sync e o hash de cada cadastro usado neles."""
+    hashes = atualizar_cadastros(tempos, sessao, forcar)
+    return _catalogos_por_hash(tuple(hashes.items())), hashes
+
+
+def _montar_catalogos(cadastros):
+    """Monta as tabelas de anos (local e safra) e de produtos a partir dos
+    cadastros."""
+    map_areas = {a["idArea"]: a["area"] for a in cadastros["areas"]}
+    map_sub = {
+        s["idSubArea"]: {"nome": s["subArea"], "pai": s["idArea"]}
+        for s in cadastros["subareas"]
+    }
+    map_local_final = {}
+    map_safra_ano = {}
+
+    for a in cadastros["anos"]:
+        d_sub = map_sub.get(a.get("idSubArea"))
+        ano_label = a.get("ano")
+        map_safra_ano[a.get("idAno")] = ano_label
+        if d_sub:
+            fazenda = map_areas.get(d_sub["pai"], "Desc.")
+            map_local_final[a.get("idAno")] = (
+                f"{fazenda} - {d_sub['nome']} ({ano_label})"
+            )
+        else:
+            map_local_final[a.get("idAno")] = f"ID {a.get('idAno')}"
+
+    map_nomes = {
+        p["idNomeProduto"]: p["nomeProduto"].upper()
+        for p in cadastros["produtosnomes"]
+        if p.get("nomeProduto")
+    }
+    map_var = {
+        v["idVariedade"]: v["nomeVariedade"].upper()
+        for v in cadastros["produtosvariedades"]
+        if v.get("nomeVariedade")
+    }
+    map_prod_final = {}
+
+    for p in cadastros["produtos"]:
+        # Filtro primário: apenas produtos do grupo 12 (Produtos Produzidos)
+        if str(p.get("idGrupo")) != "12":
+            continue
+
+        n_base = map_nomes.get(p.get("idNomeProduto"), "DESC")
+        n_var = map_var.get(p.get("idVariedade"), "")
+
+        # Filtro secundário: palavras proibidas no nome ou na variedade, como
+        # dupla segurança; o divisor vem só do nome base
+        eh_lixo, div = classificar_produto(n_base)
+        eh_lixo = eh_lixo or classificar_produto(n_var)[0]
+
+        if not eh_lixo:
+            p_id = str(p.get("idProduto"))
+            if n_var and n_var != "NH-NENHUM":
+                nome_full = f"{n_base} ({n_var}) #{p_id}" 
+                var_clean = n_var
+            else:
+                nome_full = f"{n_base} #{p_id}"
+                var_clean = "COMUM"
+
+            map_prod_final[p_id] = {
+                "nome_full": nome_full,
+                "cultura": n_base,
+                "variedade": var_clean,
+                "divisor": div,
+            }
+
+    anos = {
+        id_ano: {
+            "local_safra": local,
+            "safra_agricola": str(map_safra_ano.get(id_ano) or "N/D"),
+            "talhao_limpo": _talhao_limpo(local),
+        }
+        for id_ano, local in map_local_final.items()
+    }
+    # Em forma de tabela, para o cruzamento por coluna
+    return {
+        "tabela_anos": _tabela(
+            anos, ("local_safra", "safra_agricola", "talhao_limpo"), "N/D"
+        ),
+        "tabela_produtos": _tabela(
+            map_prod_final, ("nome_full", "cultura", "variedade", "divisor"), None
+        ),
+    }
+
+
+# Campos lidos de cada movimentação; o resto do JSON é descartado na hora
+CAMPOS_TICKET = [
+    "idTicketCompra",
+    "idFilial",
+    "idUnidadeFaturamento",
+    "tipoTicket",
+    "numeroTicket",
+    "dataTicket",
+    "observacao",
+    "obs",
+]
+CAMPOS_ITEM = ["idTicketCompraItem", "idTicketCompra", "idProduto"]
+CAMPOS_DESTINACAO = [
+    "idTicketCompraDestinacao",
+    "idTicketCompraItem",
+    "idAno",
+    "safra",
+    "quantidade",
+    "quantidadeDesconto",
+    "hectare",
+    "idLocalEstoque",
+]
+# Por que uma destinação fica de fora, na ordem em que é testado
+MOTIVOS_REJEICAO = ("ticket", "produto", "valor", "sacas")
+
+
+def _colunas(registros, campos):
+    """Um array por campo, com os valores como vieram do JSON (campo ausente
+    vira None, como em `registro.get(campo)`).
+
+    Uma passada só: cada registro é descartado assim que seus campos são
+    lidos, então `registros` pode ser um gerador (o JSON em streaming).
+    """
+    listas = {campo: [] for campo in campos}
+    for registro in registros:
+        for campo, lista in listas.items():
+            lista.append(registro.get(campo))
+    colunas = {}
+    for campo, lista in listas.items():
+        valores = np.empty(len(lista), dtype=object)  # listas e dicts ficam inteiros
+        valores[:] = lista
+        colunas[campo] = valores
+    return colunas
+
+
+def _filtrar(colunas, mascara):
+    return {c: valores[mascara] for c, valores in colunas.items()}
+
+
+def _vazio(valores):
+    """Valores que o Python trata como falsos: None, 0 e ""."""
+    return pd.isna(valores) | (valores == 0) | (valores == "")
+
+
+def _ou(valores, padrao):
+    """`valor or padrao`, elemento a elemento."""
+    return np.where(_vazio(valores), padrao, valores)
+
+
+def _float_ou_nan(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# Funções de um valor aplicadas a um array inteiro
+_texto = np.frompyfunc(str, 1, 1)  # `str(valor)`: None vira "None"
+_float = np.frompyfunc(_float_ou_nan, 1, 1)
+_decimal = np.frompyfunc(lambda valor: str(valor).replace(",", "."), 1, 1)
+_eh_producao = np.frompyfunc(lambda tipo: TIPO_TICKET in tipo, 1, 1)
+_data_sem_hora = np.frompyfunc(
+    lambda valor: valor.split(" ")[0] if isinstance(valor, str) else None, 1, 1
+)
+
+
+def _numero(valores):
+    """`float(valor)`, elemento a elemento; o que não for número vira NaN."""
+    try:
+        return valores.astype(float)  # caminho rápido: tudo já é número
+    except (TypeError, ValueError):
+        return _float(valores).astype(float)
+
+
+def _tabela(mapa, campos, padrao):
+    """{chave: {campo: valor}} → (Index das chaves, um array por campo).
+
+    Os `campos` vêm de quem chama: com o mapa vazio, cada array só tem o
+    `padrao`. Ele fica na última posição de cada array: a posição -1 que
+    get_indexer devolve para chave ausente cai nele.
+    """
+    colunas = {
+        campo: np.array([v[campo] for v in mapa.values()] + [padrao], dtype=object)
+        for campo in campos
+    }
+    return pd.Index(list(mapa), dtype=object), colunas
+
+
+def _montar_linhas(
+    tickets, itens, destinacoes, catalogos, marca=None, rejeitados=None
+):
+    """Cruza tickets, itens e destinações e devolve as linhas para o banco,
+    num DataFrame com as COLUNAS_ANALISE.
+
+    Tudo é feito por coluna: os cruzamentos são buscas de posição
+    (Index.get_indexer) e os descartes, máscaras booleanas.
+
+    Se `marca` for um dict, recebe em "ticket" o par (dataTicket, idTicketCompra)
+    do ticket válido mais recente. Se `rejeitados` for um dict, soma nele
+    quantas destinações foram descartadas por motivo (MOTIVOS_REJEICAO).
+    """
+    # Tickets: filial, unidade de faturamento e tipo
+    t = _colunas(tickets, CAMPOS_TICKET)
+    unid_fat = _texto(_ou(t["idUnidadeFaturamento"], ""))
+    t = _filtrar(
+        t,
+        np.isin(_texto(t["idFilial"]), FILIAIS_ALVO)
+        & ((unid_fat == ID_UNIDADE) | np.isin(unid_fat, ["", "None", "0"]))
+        & _eh_producao(_texto(t["tipoTicket"])).astype(bool),
+    )
+    if marca is not None:
+        com_data = ~_vazio(t["dataTicket"])
+        candidatos = list(zip(t["dataTicket"][com_data], t["idTicketCompra"][com_data]))
+        if "ticket" in marca:
+            candidatos.append(marca["ticket"])
+        if candidatos:
+            marca["ticket"] = max(candidatos)
+    # Ticket repetido: vale o último, como num dict
+    t = _filtrar(t, ~pd.Index(t["idTicketCompra"]).duplicated(keep="last"))
+    t["obs"] = _ou(_ou(t["observacao"], t["obs"]), "")
+    t["data"] = _data_sem_hora(t["dataTicket"])
+
+    # Itens dos tickets válidos, com a posição do ticket e do produto
+    i = _colunas(itens, CAMPOS_ITEM)
+    i["pos_t"] = pd.Index(t["idTicketCompra"]).get_indexer(i["idTicketCompra"])
+    i = _filtrar(i, i["pos_t"] >= 0)
+    i = _filtrar(i, ~pd.Index(i["idTicketCompraItem"]).duplicated(keep="last"))
+    idx_prod, prod = catalogos["tabela_produtos"]
+    i["pos_p"] = idx_prod.get_indexer(_texto(i["idProduto"]))
+
+    # Destinações: cada uma vira no máximo uma linha, na ordem em que chegaram
+    d = _colunas(destinacoes, CAMPOS_DESTINACAO)
+    descartes = {}
+    pos_i = pd.Index(i["idTicketCompraItem"]).get_indexer(d["idTicketCompraItem"])
+    ok = pos_i >= 0
+    descartes["ticket"] = int((~ok).sum())
+    d, pos_i = _filtrar(d, ok), pos_i[ok]
+    pos_p = i["pos_p"][pos_i]
+    ok = pos_p >= 0
+    descartes["produto"] = int((~ok).sum())
+    d, pos_i, pos_p = _filtrar(d, ok), pos_i[ok], pos_p[ok]
+    pos_t = i["pos_t"][pos_i]
+
+    qtd = _numero(_ou(d["quantidade"], 0))
+    desc = _numero(_ou(d["quantidadeDesconto"], 0))
+    hec = _numero(_decimal(_ou(d["hectare"], 0)))
+    sacas = (qtd - desc) / prod["divisor"][pos_p].astype(float)
+    data = t["data"][pos_t]
+    ok = ~(np.isnan(qtd) | np.isnan(desc) | np.isnan(hec))
+    positivo = sacas > 0
+    descartes["valor"] = int((~ok).sum() + (ok & positivo & pd.isna(data)).sum())
+    descartes["sacas"] = int((ok & ~positivo).sum())
+    ok &= positivo & pd.notna(data)
+    if rejeitados is not None:
+        for motivo, n in descartes.items():
+            rejeitados[motivo] = rejeitados.get(motivo, 0) + n
+
+    d, pos_t, pos_p = _filtrar(d, ok), pos_t[ok], pos_p[ok]
+    idx_ano, ano = catalogos["tabela_anos"]
+    pos_a = idx_ano.get_indexer(_ou(d["idAno"], d["safra"]))
+    texto = {
+        "id_ticket": d["idTicketCompraDestinacao"],
+        "data": data[ok],
+        "numero_romaneio": t["numeroTicket"][pos_t],
+        "local_safra": ano["local_safra"][pos_a],
+        "safra_agricola": ano["safra_agricola"][pos_a],
+        "produto_full": prod["nome_full"][pos_p],
+        "cultura": prod["cultura"][pos_p],
+        "variedade": prod["variedade"][pos_p],
+        "id_local_estoque": _texto(d["idLocalEstoque"]),
+        "obs": t["obs"][pos_t],
+        "talhao_limpo": ano["talhao_limpo"][pos_a],
+    }
+    numeros = {
+        "divisor": prod["divisor"][pos_p].astype(float),
+        "peso_bruto": qtd[ok],
+        "desconto": desc[ok],
+        "peso_liquido": (qtd - desc)[ok],
+        "sacas": sacas[ok],
+        "hectares": hec[ok],
+    }
+    # dtype=object: os textos ficam como vieram, sem conversão de tipo
+    colunas = {c: pd.Series(v, dtype=object, copy=False) for c, v in texto.items()}
+    colunas.update({c: pd.Series(v, copy=False) for c, v in numeros.items()})
+    return pd.DataFrame(colunas, columns=COLUNAS_ANALISE, copy=False)
+
+
+def dividir_periodo(dt_inicio, dt_fim, meses=JANELA_MESES):
+    """Quebra [dt_inicio, dt_fim] em janelas consecutivas de `meses` meses."""
+    janelas = []
+    ini = dt_inicio
+    while ini <= dt_fim:
+        idx = ini.year * 12 + ini.month - 1 + meses
+        prox = date(idx // 12, idx % 12 + 1, 1)
+        janelas.append((ini, min(prox - timedelta(days=1), dt_fim)))
+        ini = prox
+    return janelas
+
+
+def _processar_janela(ini, fim, catalogos, sessao, tempos):
+    """Baixa e cruza as movimentações de uma janela. Levanta ErroAPI se falhar."""
+    str_ini = ini.strftime("%d%m%Y")
+    str_fim = fim.strftime("%d%m%Y")
+    t_janela = {}
+    # Geradores: o cruzamento filtra cada item conforme ele chega da rede
+    tickets = iterar_json("ticketscompras", str_ini, str_fim, sessao, t_janela)
+    itens = iterar_json("ticketscomprasitens", str_ini, str_fim, sessao, t_janela)
+    destinacoes = iterar_json(
+        "ticketscomprasdestinacoes", str_ini, str_fim, sessao, t_janela
+    )
+    marca = {}
+    rejeitados = {}
+    rows = _montar_linhas(tickets, itens, destinacoes, catalogos, marca, rejeitados)
+    for ep, seg in t_janela.items():
+        tempos[f"{ep} {ini:%m/%Y}"] = seg
+    return rows, marca.get("ticket"), rejeitados
+
+
+def _gravar_linhas(conn, rows, periodo=None):
+    """Grava as linhas com upsert por id_ticket, numa única transação.
+
+    Com `periodo=(ini, fim)`, apaga antes os registros do intervalo que não
+    vieram de novo (substituição do período). Retorna o número de linhas.
+    """
+    with conn:
+        if periodo:
+            ini, fim = periodo
+            conn.execute(
+                "DELETE FROM analise_produtividade WHERE data >= ? AND data < ?",
+                (
+                    ini.strftime("%Y-%m-%d"),
+                    (fim + timedelta(days=1)).strftime("%Y-%m-%d"),
+                ),
+            )
+        # tolist() devolve tipos nativos do Python, prontos para o sqlite3
+        conn.executemany(
+            SQL_UPSERT_ANALISE, zip(*(rows[col].tolist() for col in COLUNAS_ANALISE))
+        )
+    return len(rows)
+
+
+def _gravar_janela(conn, rows, ini, fim):
+    """Substitui no banco os registros do período [ini, fim] pelas linhas novas."""
+    return _gravar_linhas(conn, rows, (ini, fim))
+
+
+def _upsert_janela(conn, rows, ini, fim):
+    """Insere ou atualiza as linhas por id_ticket, sem apagar o período."""
+    return _gravar_linhas(conn, rows)
+
+
+def _hash_json(dados):
+    return hashlib.sha1(
+        json.dumps(dados, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _ler_checkpoints():
+    conn = _conectar()
+    try:
+        return {
+            ep: {"ultima_data": d, "ultimo_id": i, "hash": h}
+            for ep, d, i, h in conn.execute(
+                "SELECT endpoint, ultima_data, ultimo_id, hash FROM sync_checkpoint"
+            )
+        }
+    finally:
+        conn.close()
+
+
+def _salvar_checkpoint(
+    conn, endpoint, ultima_data=None, ultimo_id=None, hash_=None
+):
+    """Atualiza o checkpoint do endpoint; campos None mantêm o valor anterior."""
+    conn.execute(
+        """
+        INSERT INTO sync_checkpoint
+            (endpoint, ultima_data, ultimo_id, hash, atualizado_em)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(endpoint) DO UPDATE SET
+            ultima_data = COALESCE(excluded.ultima_data, ultima_data),
+            ultimo_id = COALESCE(excluded.ultimo_id, ultimo_id),
+            hash = COALESCE(excluded.hash, hash),
+            atualizado_em = excluded.atualizado_em
+    """,
+        (endpoint, ultima_data, ultimo_id, hash_, datetime.now(FUSO_SP).isoformat()),
+    )
+
+
+def _schema_snapshot():
+    """Schema Arrow dos arquivos do snapshot (safra_agricola fica no caminho)."""
+    tipos = {}
+    for col in COLUNAS_ANALISE:
+        if col == "data":
+            tipos[col] = pa.date32()
+        elif col in COLUNAS_NUMERICAS:
+            tipos[col] = pa.float64()
+        elif col in COLUNAS_CATEGORIA:
+            tipos[col] = pa.dictionary(pa.int32(), pa.string())
+        else:
+            tipos[col] = pa.string()
+    return pa.schema([(c, t) for c, t in tipos.items() if c != "safra_agricola"])
+
+
+def _escrever_particao(conn, safra, destino):
+    """Regrava o arquivo Parquet de uma safra a partir do banco."""
+    cols = [c for c in COLUNAS_ANALISE if c != "safra_agricola"]
+    df = pd.read_sql(
+        f"SELECT {', '.join(cols)} FROM analise_produtividade "
+        "WHERE safra_agricola = ?",
+        conn,
+        params=[safra],
+    )
+    pasta = os.path.join(destino, f"safra_agricola={quote(safra, safe='')}")
+    if df.empty:
+        shutil.rmtree(pasta, ignore_errors=True)
+        return
+    df["data"] = pd.to_datetime(df["data"], format="%Y-%m-%d")
+    tabela = pa.Table.from_pandas(df, schema=_schema_snapshot(), preserve_index=False)
+    os.makedirs(pasta, exist_ok=True)
+    # Prefixo "." fica fora da leitura até o os.replace atômico
+    tmp = os.path.join(pasta, ".part-0.parquet.tmp")
+    pq.write_table(tabela, tmp, compression="zstd")
+    os.replace(tmp, os.path.join(pasta, "part-0.parquet"))
+
+
+def atualizar_snapshot(conn, safras=None):
+    """Atualiza o snapshot Parquet (uma partição por safra) usado na leitura.
+
+    Com `safras`, regrava só essas partições; sem, reconstrói tudo numa pasta
+    nova e troca de uma vez. Se falhar, apaga o snapshot para que a leitura
+    volte ao SQLite em vez de mostrar dados velhos.
+    """
+    if pa is None:
+        return
+    try:
+        if safras is not None and os.path.isdir(SNAPSHOT_DIR):
+            for safra in safras:
+                _escrever_particao(conn, safra, SNAPSHOT_DIR)
+            return
+
+        novo = SNAPSHOT_DIR + ".novo"
+        antigo = SNAPSHOT_DIR + ".antigo"
+        shutil.rmtree(novo, ignore_errors=True)
+        os.makedirs(novo)
+        for (safra,) in conn.execute(
+            "SELECT DISTINCT safra_agricola FROM analise_produtividade"
+        ):
+            _escrever_particao(conn, safra, novo)
+        if os.path.isdir(SNAPSHOT_DIR):
+            os.replace(SNAPSHOT_DIR, antigo)
+        os.replace(novo, SNAPSHOT_DIR)
+        shutil.rmtree(antigo, ignore_errors=True)
+    except Exception:
+        log.exception("Falha ao gravar o snapshot; leitura volta ao SQLite")
+        shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+
+
+def _safras_no_periodo(conn, dt_inicio, dt_fim):
+    return {
+        r[0]
+        for r in conn.execute(
+            "SELECT DISTINCT safra_agricola FROM analise_produtividade "
+            "WHERE data >= ? AND data <= ?",
+            (dt_inicio.isoformat(), dt_fim.isoformat()),
+        )
+    }
+
+
+def _safras_a_refazer(conn, modo, safras_antes, dt_inicio, dt_fim):
+    """Safras cujo resumo e snapshot a sync refaz: todas (None) no modo total;
+    senão as que o período tinha antes da sync e as que tem agora."""
+    if modo == "total":
+        return None
+    return safras_antes | _safras_no_periodo(conn, dt_inicio, dt_fim)
+
+
+def atualizar_resumo(conn, safras=None):
+    """Refaz o resumo diário das `safras` (todas, se None) a partir das linhas."""
+    if safras is None:
+        conn.execute("DELETE FROM resumo_diario")
+        conn.execute(SQL_RESUMO.format(where="1"))
+        return
+    safras = list(safras)
+    if not safras:
+        return
+    marcas = ", ".join("?" * len(safras))
+    conn.execute(
+        f"DELETE FROM resumo_diario WHERE safra_agricola IN ({marcas})", safras
+    )
+    conn.execute(SQL_RESUMO.format(where=f"safra_agricola IN ({marcas})"), safras)
+
+
+def _publicar(conn, safras, ultima_sync=None):
+    """Refaz o resumo diário e o snapshot das `safras` (todas, se None) e
+    publica uma nova versão dos dados (sync_log.versao).
+
+    Sem `ultima_sync` (sync interrompida), a data da última sync fica como
+    estava: só a versão muda, para os caches não servirem dados velhos.
+    """
+    atualizar_resumo(conn, safras)
+    conn.commit()
+    atualizar_snapshot(conn, safras)
+    # Só agora o snapshot está pronto: a versão nova pode ser vista
+    conn.execute(
+        """
+        INSERT INTO sync_log (id, ultima_sync, versao) VALUES (1, ?, 1)
+        ON CONFLICT(id) DO UPDATE SET
+            ultima_sync = COALESCE(excluded.ultima_sync, ultima_sync),
+            versao = versao + 1
+    """,
+        (ultima_sync,),
+    )
+    conn.commit()
+
+
+def sincronizar_dados(modo="parcial", progresso=None, sessao=None):
+    """Baixa a API e grava no banco.
+
+    - "total": tudo desde DATA_INICIO_TOTAL, substituindo o período.
+    - "parcial": o mês corrente, substituindo o período.
+    - "incremental": só o que veio depois do checkpoint de ticketscompras,
+      com upsert por id_ticket. Sem checkpoint, cai no modo parcial.
+
+    `progresso(pct, mensagem)` é chamado a cada etapa. Retorna um resumo
+    com modo, registros, destinações descartadas por motivo, janelas que
+    falharam, erro e tempos por endpoint.
+    """
+    avisar = progresso or (lambda pct, mensagem: None)
+    sessao = sessao or _sessao_http()
+    t_inicio = time.perf_counter()
+    hoje = datetime.now(FUSO_SP)
+    dt_fim = hoje.date()
+    inicio_mes = date(hoje.year, hoje.month, 1)
+    checkpoints = _ler_checkpoints()
+    marca_ticket = checkpoints.get("ticketscompras", {}).get("ultima_data")
+
+    if modo == "incremental" and not marca_ticket:
+        modo = "parcial"
+
+    if modo == "parcial":
+        dt_inicio = inicio_mes
+    elif modo == "incremental":
+        # O dia do checkpoint é refeito: tickets do mesmo dia podem chegar depois
+        dt_inicio = date.fromisoformat(marca_ticket)
+    else:
+        dt_inicio = DATA_INICIO_TOTAL
+
+    tempos = {}
+    resumo = {
+        "modo": modo,
+        "periodo": (dt_inicio, dt_fim),
+        "registros": 0,
+        "falhas": [],
+        "erro": None,
+        "tempos": tempos,
+    }
+
+    avisar(0, "Baixando Cadastros...")
+    try:
+        # "Atualizar Tudo" revalida os cadastros mesmo dentro do TTL
+        catalogos, hashes = carregar_catalogos(tempos, sessao, forcar=modo == "total")
+    except ErroAPI as e:
+        resumo["erro"] = f"Falha ao baixar cadastros ({e}). Nada foi alterado."
+        return resumo
+
+    gravar = _gravar_janela
+    if modo == "incremental":
+        mudou = [
+            ep for ep, h in hashes.items() if checkpoints.get(ep, {}).get("hash") != h
+        ]
+        if mudou:
+            # Nomes/locais podem ter mudado: refaz o mês inteiro com os novos mapas
+            log.info("Cadastros alterados (%s): incremental vira parcial", mudou)
+            dt_inicio = min(dt_inicio, inicio_mes)
+        else:
+            gravar = _upsert_janela
+
+    # Safras que o período tinha antes da sync (com dt_inicio já definitivo):
+    # as que somem ou mudam de nome também têm o resumo e o snapshot refeitos
+    conn = _conectar()
+    safras_afetadas = _safras_no_periodo(conn, dt_inicio, dt_fim)
+    conn.close()
+
+    janelas = dividir_periodo(dt_inicio, dt_fim)
+    total_rows = 0
+    falhas = []
+    marcas = []
+    rejeitados = dict.fromkeys(MOTIVOS_REJEICAO, 0)
+
+    avisar(15, "Baixando Movimentações...")
+    conn = _conectar()
+    try:
+        # Janelas baixadas em paralelo; cada uma é gravada assim que chega.
+        # Só JANELAS_EM_VOO por vez: as linhas baixadas e ainda não gravadas
+        # não se acumulam se a rede for mais rápida que o banco
+        fila = iter(janelas)
+        futuros = {}
+        n = 0
+        with ThreadPoolExecutor(max_workers=JANELA_WORKERS) as pool:
+            while True:
+                for ini, fim in itertools.islice(fila, JANELAS_EM_VOO - len(futuros)):
+                    futuro = pool.submit(
+                        _processar_janela, ini, fim, catalogos, sessao, tempos
+                    )
+                    futuros[futuro] = (ini, fim)
+                if not futuros:
+                    break
+                prontos, _ = wait(futuros, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    # Sai do dict já: o Future guarda as linhas até ser solto
+                    ini, fim = futuros.pop(futuro)
+                    n += 1
+                    try:
+                        rows, marca, rej = futuro.result()
+                    except ErroAPI:
+                        falhas.append((ini, fim))
+                    else:
+                        total_rows += gravar(conn, rows, ini, fim)
+                        marcas.append(marca)
+                        for motivo, qtd in rej.items():
+                            rejeitados[motivo] += qtd
+                    avisar(
+                        15 + int(80 * n / len(janelas)),
+                        f"Baixando Movimentações... {n}/{len(janelas)}",
+                    )
+
+        # Janelas que falharam são repetidas sozinhas, sem refazer o resto
+        for _ in range(JANELA_TENTATIVAS):
+            pendentes, falhas = falhas, []
+            for ini, fim in pendentes:
+                avisar(95, f"Repetindo {ini:%d/%m/%Y} a {fim:%d/%m/%Y}...")
+                try:
+                    rows, marca, rej = _processar_janela(
+                        ini, fim, catalogos, sessao, tempos
+                    )
+                except ErroAPI:
+                    falhas.append((ini, fim))
+                else:
+                    total_rows += gravar(conn, rows, ini, fim)
+                    marcas.append(marca)
+                    for motivo, qtd in rej.items():
+                        rejeitados[motivo] += qtd
+
+        for ep, h in hashes.items():
+            _salvar_checkpoint(conn, ep, hash_=h)
+        # Só avança a marca se nenhuma janela ficou para trás
+        marcas = [m for m in marcas if m]
+        if marcas and not falhas:
+            data_ticket, id_ticket = max(marcas)
+            _salvar_checkpoint(
+                conn, "ticketscompras", data_ticket.split(" ")[0], str(id_ticket)
+            )
+    except BaseException:
+        # Cada janela é gravada na sua própria transação: as que já entraram
+        # no banco antes da falha também entram no resumo e no snapshot
+        conn.rollback()
+        try:
+            _publicar(
+                conn,
+                _safras_a_refazer(conn, modo, safras_afetadas, dt_inicio, dt_fim),
+            )
+        except Exception:
+            log.exception("Falha ao refazer o resumo após a sync interromper")
+        conn.close()
+        raise
+
+    try:
+        # O resumo e o snapshot são refeitos depois de todas as janelas
+        avisar(97, "Gerando snapshot...")
+        _publicar(
+            conn,
+            _safras_a_refazer(conn, modo, safras_afetadas, dt_inicio, dt_fim),
+            datetime.now(FUSO_SP).isoformat(),
+        )
+    finally:
+        conn.close()
+
+    log.info("Sync %s: %d registros; tempos por endpoint: %s", modo, total_rows, tempos)
+    log.info("Sync %s: destinações descartadas por motivo: %s", modo, rejeitados)
+    resumo["periodo"] = (dt_inicio, dt_fim)
+    resumo["registros"] = total_rows
+    resumo["rejeitados"] = rejeitados
+    resumo["falhas"] = falhas
+    resumo["duracao"] = time.perf_counter() - t_inicio
+    return resumo
+
+
+def mensagem_sync(resumo):
+    """Texto curto para o usuário a partir do resumo de sincronizar_dados."""
+    if resumo["erro"]:
+        return resumo["erro"]
+    if resumo["falhas"]:
+        periodos = ", ".join(f"{i:%m/%Y}" for i, _ in resumo["falhas"])
+        return (
+            f"Atualizado parcialmente: {resumo['registros']} registros. "
+            f"Falha ao baixar: {periodos}."
+        )
+    return f"Atualizado! {resumo['registros']} registros."
+
+
+# --- Execução da sync: trava única entre sessões e processos ---
+def _adquirir_trava(modo):
+    """Reserva a sync para quem chamou. Retorna o id do dono, ou None se outra
+    sync (deste ou de outro processo) ainda está rodando."""
+    dono = uuid.uuid4().hex
+    agora = time.time()
+    conn = _conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT dono, expira FROM sync_execucao WHERE id = 1"
+        ).fetchone()
+        if row and row[0] and row[1] > agora:
+            conn.rollback()
+            return None
+        conn.execute(
+            """
+            INSERT INTO sync_execucao
+                (id, dono, modo, inicio, expira, fim, progresso, mensagem, sucesso)
+            VALUES (1, ?, ?, ?, ?, NULL, 0, 'Iniciando...', NULL)
+            ON CONFLICT(id) DO UPDATE SET
+                dono = excluded.dono, modo = excluded.modo,
+                inicio = excluded.inicio, expira = excluded.expira, fim = NULL,
+                progresso = 0, mensagem = excluded.mensagem, sucesso = NULL
+        """,
+            (dono, modo, agora, agora + SYNC_TRAVA_TTL),
+        )
+        conn.commit()
+        return dono
+    finally:
+        conn.close()
+
+
+def _registrar_progresso(dono, pct, mensagem):
+    """Publica o progresso e renova a trava (a sync segue viva)."""
+    conn = _conectar()
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE sync_execucao SET progresso = ?, mensagem = ?, expira = ? "
+                "WHERE id = 1 AND dono = ?",
+                (pct, mensagem, time.time() + SYNC_TRAVA_TTL, dono),
+            )
+    finally:
+        conn.close()
+
+
+def _liberar_trava(dono, sucesso, mensagem):
+    conn = _conectar()
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE sync_execucao SET dono = NULL, fim = ?, progresso = 100, "
+                "mensagem = ?, sucesso = ? WHERE id = 1 AND dono = ?",
+                (time.time(), mensagem, int(sucesso), dono),
+            )
+    finally:
+        conn.close()
+
+
+def estado_sync():
+    """Situação da sync atual ou da última: rodando, progresso, mensagem..."""
+    conn = _conectar()
+    try:
+        row = conn.execute(
+            "SELECT dono, modo, progresso, mensagem, expira, fim, sucesso "
+            "FROM sync_execucao WHERE id = 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return {"rodando": False, "modo": None, "progresso": 0, "mensagem": "",
+                "fim": None, "sucesso": None}
+    dono, modo, pct, mensagem, expira, fim, sucesso = row
+    return {
+        "rodando": bool(dono) and expira > time.time(),
+        "modo": modo,
+        "progresso": pct or 0,
+        "mensagem": mensagem or "",
+        "fim": fim,
+        "sucesso": None if sucesso is None else bool(sucesso),
+    }
+
+
+def _executar_com_trava(dono, modo, sessao=None, progresso=None):
+    def avisar(pct, msg):
+        _registrar_progresso(dono, pct, msg)
+        if progresso:
+            progresso(pct, msg)
+
+    sucesso = False
+    mensagem = "Sincronização interrompida."
+    resumo = {"modo": modo, "registros": 0, "falhas": [], "erro": mensagem, "tempos": {}}
+    try:
+        resumo = sincronizar_dados(modo, avisar, sessao)
+        sucesso = not resumo["erro"] and not resumo["falhas"]
+        mensagem = mensagem_sync(resumo)
+    except Exception as e:
+        log.exception("Sync %s falhou", modo)
+        mensagem = resumo["erro"] = f"Erro na sincronização: {e}"
+    finally:
+        _liberar_trava(dono, sucesso, mensagem)
+    return resumo
+
+
+def executar_sync(modo, progresso=None):
+    """Roda a sync nesta thread, respeitando a trava. Retorna o resumo, ou
+    None se outra sync já está rodando."""
+    dono = _adquirir_trava(modo)
+    if dono is None:
+        return None
+    return _executar_com_trava(dono, modo, progresso=progresso)
+
+
+def iniciar_sync_em_segundo_plano(modo):
+    """Dispara a sync numa thread e volta na hora.
+
+    Se já existe uma sync rodando, não inicia outra: quem pediu apenas
+    acompanha a que está em andamento. Retorna True se iniciou.
+    """
+    dono = _adquirir_trava(modo)
+    if dono is None:
+        return False
+    threading.Thread(
+        target=_executar_com_trava,
+        args=(dono, modo, _sessao_http()),
+        name=f"sync-{modo}",
+        daemon=True,
+    ).start()
+    return True
+
+
+def ultima_sincronizacao():
+    """Momento (SP) da última sync concluída, ou None."""
+    conn = _conectar()
+    try:
+        row = conn.execute(
+            "SELECT ultima_sync FROM sync_log WHERE id = 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    ultima = datetime.fromisoformat(row[0])
+    if ultima.tzinfo is None:
+        ultima = FUSO_SP.localize(ultima)
+    return ultima
+
+
+def precisa_sincronizar() -> bool:
+    """Retorna True se a última sync é anterior às 06:00 mais recentes (SP).
+
+    Antes das 06:00 o corte é o de ontem. Não pede nova sync enquanto uma
+    estiver rodando, nem logo depois de uma tentativa que falhou.
+    """
+    try:
+        estado = estado_sync()
+        if estado["rodando"]:
+            return False
+        if estado["sucesso"] is False and estado["fim"]:
+            if time.time() - estado["fim"] < SYNC_PAUSA_APOS_FALHA:
+                return False
+        ultima = ultima_sincronizacao()
+        if ultima is None:
+            return True  # Nunca sincronizou
+        agora = datetime.now(FUSO_SP)
+        limite = agora.replace(hour=6, minute=0, second=0, microsecond=0)
+        if agora < limite:
+            limite -= timedelta(days=1)
+        return ultima < limite
+    except Exception:
+        return True
+
+
+def versao_dados():
+    """Número da versão dos dados, incrementado a cada sync."""
+    conn = _conectar()
+    try:
+        row = conn.execute("SELECT versao FROM sync_log WHERE id = 1").fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+
+# --- 4. LINHA DE COMANDO ---
+def _progresso_terminal(pct, mensagem):
+    print(f"[{pct:3d}%] {mensagem}", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m backend", description="Sincroniza a API com o banco local."
+    )
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    sync = comandos.add_parser("sync", help="baixa a API e atualiza o banco")
+    sync.add_argument(
+        "--mode",
+        choices=("parcial", "total", "incremental"),
+        default="parcial",
+        help="período sincronizado (padrão: parcial, o mês corrente)",
+    )
+    sync.add_argument(
+        "--quiet", action="store_true", help="não mostra o progresso no stderr"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    init_db()
+    resumo = executar_sync(
+        args.mode, progresso=None if args.quiet else _progresso_terminal
+    )
+    if resumo is None:
+        ocupado = {"modo": args.mode, "erro": "Outra sincronização está rodando."}
+        print(json.dumps(ocupado, ensure_ascii=False))
+        return 2
+    print(json.dumps(resumo, default=str, ensure_ascii=False))
+    return 1 if resumo["erro"] or resumo["falhas"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
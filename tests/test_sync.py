@@ -0,0 +1,217 @@
+"""Sync contra uma API falsa, num banco temporário."""
+import json
+import sqlite3
+from datetime import date, datetime
+
+import pytest
+
+import backend
+
+HOJE = date(2024, 5, 20)
+
+CADASTROS = {
+    "areas": [{"idArea": 1, "area": "FAZ"}],
+    "subareas": [{"idSubArea": 1, "subArea": "T1", "idArea": 1}],
+    "anos": [
+        {"idAno": 1, "idSubArea": 1, "ano": "2023/2024"},
+        {"idAno": 2, "idSubArea": 1, "ano": "2024/2025"},
+    ],
+    "produtos": [{"idProduto": 10, "idNomeProduto": 1, "idVariedade": 1, "idGrupo": 12}],
+    "produtosnomes": [{"idNomeProduto": 1, "nomeProduto": "Soja"}],
+    "produtosvariedades": [{"idVariedade": 1, "nomeVariedade": "Olimpo"}],
+}
+
+
+def _ticket(id_, dia, id_ano):
+    """Um ticket com um item e uma destinação de 100 sacas."""
+    return (
+        {
+            "idTicketCompra": id_,
+            "numeroTicket": str(id_),
+            "dataTicket": f"{dia.isoformat()} 00:00:00",
+            "idFilial": 2,
+            "idUnidadeFaturamento": 1,
+            "tipoTicket": "Entrada Produção",
+            "observacao": "",
+        },
+        {"idTicketCompraItem": id_, "idTicketCompra": id_, "idProduto": 10},
+        {
+            "idTicketCompraDestinacao": id_,
+            "idTicketCompraItem": id_,
+            "idAno": id_ano,
+            "quantidade": 6000,
+            "quantidadeDesconto": 0,
+            "hectare": 10,
+            "idLocalEstoque": 1,
+        },
+    )
+
+
+class _Resposta:
+    def __init__(self, dados):
+        self.status_code = 200
+        self.headers = {}
+        self.encoding = "utf-8"
+        self._texto = json.dumps(dados)
+
+    def json(self):
+        return json.loads(self._texto)
+
+    def iter_content(self, tamanho, decode_unicode=False):
+        for i in range(0, len(self._texto), tamanho):
+            yield self._texto[i : i + tamanho]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _SessaoFalsa:
+    """Responde como a API: cadastros inteiros e movimentações por período."""
+
+    def __init__(self, cadastros, tickets):
+        self.cadastros = cadastros
+        self.tickets = tickets
+
+    def get(self, url, timeout=None, stream=False, headers=None):
+        partes = url.split("/")[3:]
+        endpoint = partes[0]
+        if endpoint in self.cadastros:
+            return _Resposta(self.cadastros[endpoint])
+        ini, fim = (datetime.strptime(p, "%d%m%Y").date() for p in partes[1:3])
+        no_periodo = [
+            t
+            for t in self.tickets
+            if ini.isoformat() <= t[0]["dataTicket"][:10] <= fim.isoformat()
+        ]
+        indice = {
+            "ticketscompras": 0,
+            "ticketscomprasitens": 1,
+            "ticketscomprasdestinacoes": 2,
+        }[endpoint]
+        return _Resposta([t[indice] for t in no_periodo])
+
+
+class _Agora(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return tz.localize(cls(HOJE.year, HOJE.month, HOJE.day, 12))
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backend, "datetime", _Agora)
+    monkeypatch.setattr(backend, "CADASTRO_TTL", 0)  # revalida a cada sync
+    monkeypatch.setattr(
+        backend,
+        "_config_api",
+        {"base_url": "http://api", "cliente": "c", "token": "t",
+         "auth_user": "u", "auth_pass": "p"},
+    )
+    backend._catalogos_por_hash.cache_clear()
+    backend.init_db()
+    return tmp_path
+
+
+def _sacas_por_safra(tabela):
+    conn = sqlite3.connect(backend.DB_FILE)
+    try:
+        return dict(
+            conn.execute(
+                f"SELECT safra_agricola, ROUND(SUM(sacas), 6) FROM {tabela} "
+                "GROUP BY safra_agricola"
+            ).fetchall()
+        )
+    finally:
+        conn.close()
+
+
+def _sacas_snapshot():
+    pytest.importorskip("pyarrow")
+    df = backend.pd.read_parquet(backend.SNAPSHOT_DIR)
+    return df.groupby("safra_agricola", observed=True)["sacas"].sum().round(6).to_dict()
+
+
+def test_incremental_com_cadastro_alterado_refaz_safras_antigas(banco):
+    # Dia 1 na safra antiga, hoje na nova: o checkpoint fica em HOJE
+    tickets = [_ticket(1, date(2024, 5, 1), 1), _ticket(2, HOJE, 2)]
+    sessao = _SessaoFalsa(json.loads(json.dumps(CADASTROS)), tickets)
+    backend.sincronizar_dados("parcial", sessao=sessao)
+    assert _sacas_por_safra("resumo_diario") == {"2023/2024": 100.0, "2024/2025": 100.0}
+
+    # A safra renomeada só tem linhas antes do checkpoint; o incremental
+    # volta ao início do mês e precisa refazer a safra antiga também
+    sessao.cadastros["anos"][0]["ano"] = "2023/24"
+    resumo = backend.sincronizar_dados("incremental", sessao=sessao)
+    assert resumo["periodo"][0] == date(2024, 5, 1)
+
+    esperado = {"2023/24": 100.0, "2024/2025": 100.0}
+    assert _sacas_por_safra("analise_produtividade") == esperado
+    assert _sacas_por_safra("resumo_diario") == esperado
+    assert _sacas_snapshot() == esperado
+
+
+def _sync_log():
+    conn = sqlite3.connect(backend.DB_FILE)
+    try:
+        return conn.execute("SELECT ultima_sync, versao FROM sync_log").fetchone()
+    finally:
+        conn.close()
+
+
+def test_sync_interrompida_refaz_resumo_das_janelas_gravadas(banco, monkeypatch):
+    tickets = [_ticket(1, date(2024, 5, 1), 1)]
+    sessao = _SessaoFalsa(json.loads(json.dumps(CADASTROS)), tickets)
+    backend.sincronizar_dados("parcial", sessao=sessao)
+    ultima_sync, versao = _sync_log()
+
+    # A janela é gravada; a sync falha depois, ao salvar os checkpoints
+    tickets.append(_ticket(2, HOJE, 2))
+
+    def _falhar(*args, **kwargs):
+        raise RuntimeError("disco cheio")
+
+    monkeypatch.setattr(backend, "_salvar_checkpoint", _falhar)
+    with pytest.raises(RuntimeError):
+        backend.sincronizar_dados("parcial", sessao=sessao)
+
+    esperado = {"2023/2024": 100.0, "2024/2025": 100.0}
+    assert _sacas_por_safra("analise_produtividade") == esperado
+    assert _sacas_por_safra("resumo_diario") == esperado
+    assert _sacas_snapshot() == esperado
+    # Nova versão para os caches, mas a última sync completa continua a mesma
+    assert _sync_log() == (ultima_sync, versao + 1)
+
+
+@pytest.mark.parametrize("cadastro", ["produtos", "anos"])
+def test_cadastro_vazio_nao_derruba_a_sync(banco, cadastro):
+    cadastros = json.loads(json.dumps(CADASTROS))
+    cadastros[cadastro] = []
+    sessao = _SessaoFalsa(cadastros, [_ticket(1, HOJE, 2)])
+    resumo = backend.sincronizar_dados("parcial", sessao=sessao)
+
+    assert resumo["falhas"] == []
+    if cadastro == "produtos":
+        # Sem produto do grupo 12, a destinação é descartada
+        assert resumo["registros"] == 0
+        assert resumo["rejeitados"]["produto"] == 1
+    else:
+        # Sem o ano, a linha entra com local e safra "N/D"
+        assert resumo["registros"] == 1
+        assert _sacas_por_safra("analise_produtividade") == {"N/D": 100.0}
+
+
+def test_variedade_com_palavra_proibida_fica_de_fora(banco):
+    cadastros = json.loads(json.dumps(CADASTROS))
+    cadastros["produtosvariedades"][0]["nomeVariedade"] = "Semente S1"
+    sessao = _SessaoFalsa(cadastros, [_ticket(1, HOJE, 2)])
+    resumo = backend.sincronizar_dados("parcial", sessao=sessao)
+
+    assert resumo["registros"] == 0
+    assert resumo["rejeitados"]["produto"] == 1